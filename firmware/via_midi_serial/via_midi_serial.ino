@@ -2,11 +2,24 @@
  * Control drums via MIDI and/or serial port.
  * 
  * Serial port:
- *   19200 baud, ascii format, terminate with linefeed
+ *   19200 baud (can be raised via "baud" command), ascii format, terminate with linefeed
  *   Numbers 1-8 directly trigger drum channels 1-8
  *   h<i>/r<i>  trigger/release channel i-SERIAL_BASE_NOTE
  *   mute       release all drum channels
  *   id?        returns id-string
+ *   proto?     returns supported protocols ("ASCII BIN1 BAUD")
+ *   baud <b>   answers "OK <b>" and switches to baudrate <b>, or answers "ERR" if
+ *              not supported. The new rate must be confirmed by sending "id?" or
+ *              "trommelbold?" within BAUD_CONFIRM_MS, otherwise we fall back to
+ *              SERIAL_BAUDRATE.
+ *
+ *   Binary commands (no line termination). Opcodes are >= 0x80, <mask> has
+ *   bit 0 set for drum channel 1:
+ *   0x80 <mask>             hit channels
+ *   0x81 <mask>             release channels
+ *   0x82 <mask> <ms>        hit channels with duration <ms>
+ *   0x83 <mask> <ms>...     hit channels, one duration byte per channel in mask
+ *   A duration of 0 selects the default beat duration.
  * 
  * MIDI:
  *   Note-On/Off <i> events trigger drum channels i-MIDI_BASE_NOTE
@@ -28,6 +41,9 @@
 
 #define  TROMMELBOLD_ID  "Trommelbold-v1.0"   // Device id string, can be queried via serial command "id?"
 
+#define  SERIAL_BAUDRATE   19200   // Initial baudrate, and fallback if a baudrate change is not confirmed
+#define  BAUD_CONFIRM_MS   1000    // Time to confirm a new baudrate
+
 // By default, we use our own software serial implementation for MIDI i/o, since the version
 // from the Arduino library has some severe deficiencies (eg. completly blocks while sending
 // and receiving.
@@ -78,7 +94,7 @@ void setup()
     // :NOTE: When using the built-in software serial class, it is import ant to set the hardware serial baudrate
     //   SMALLER than the software serial baudrate (31250 for midi). When using our custom software serial 
     //   implementation, this is no issue.
-    Serial.begin(19200);  
+    Serial.begin(SERIAL_BAUDRATE);  
     Serial.println("Yabadabadoo!");
 }
 
@@ -91,6 +107,7 @@ void loop()
     #endif
     #if RECV_SERIAL
         serial_tick();
+        baud_tick();
     #endif
     
     drum.tick();
@@ -200,14 +217,39 @@ void print_midi(uint8_t stat, uint8_t data1, uint8_t data2)
 //=============================================================================================================
 // Serial handling
 
+// Binary command opcodes
+#define  BIN_HIT       0x80
+#define  BIN_RELEASE   0x81
+#define  BIN_HIT_DUR   0x82
+#define  BIN_HIT_DURS  0x83
+
 void serial_tick(void)
 {
     static char cmd_buffer[20] = {0};   // Buffer for incoming command strings
     static uint8_t tail = 0;     // Next free position in buffer
+    static uint8_t bin_cmd = 0;  // Opcode of binary command being received, 0 if none
+    static uint8_t bin_data[1+N_CHAN];  // Binary command arguments
+    static uint8_t bin_len = 0, bin_need = 0;
     while (Serial.available())
     {
         char in = Serial.read();
-        if (in != '\r'  &&  in != '\n')  // line termination?
+        if (bin_cmd)  // Receiving binary command arguments
+        {
+            bin_data[bin_len++] = in;
+            if (bin_len == 1)  // Got channel mask, now we know the command length
+                bin_need = bin_cmd_length( bin_cmd, bin_data[0] );
+            if (bin_len >= bin_need)  {
+                eval_binary_cmd( bin_cmd, bin_data );
+                bin_cmd = 0;
+            }
+        }
+        else if ((uint8_t)in >= 0x80)  // Start of binary command
+        {
+            bin_cmd = in;
+            bin_len = 0;
+            bin_need = 1;
+        }
+        else if (in != '\r'  &&  in != '\n')  // line termination?
         {
             // Copy new character to input buffer.
             // On input buffer overflows, we just drop further bytes
@@ -225,14 +267,51 @@ void serial_tick(void)
 }
 
 
+// Baudrate negotiation
+const uint32_t baudrates[] = {19200, 38400, 57600, 115200, 250000, 500000, 1000000};
+uint32_t baud_confirm_start = 0;   // Time of last baudrate change
+uint8_t baud_unconfirmed = 0;      // New baudrate not yet confirmed by host
+
+void set_baudrate( uint32_t baud )
+{
+    for (uint8_t i=0; i<sizeof(baudrates)/sizeof(baudrates[0]); i++)  {
+        if (baudrates[i] == baud)  {
+            Serial.print("OK "); Serial.println(baud);
+            Serial.flush();      // Wait until answer is sent
+            Serial.begin(baud);
+            baud_confirm_start = millis();
+            baud_unconfirmed = (baud != SERIAL_BAUDRATE);
+            return;
+        }
+    }
+    Serial.println("ERR");
+}
+
+void baud_tick(void)
+{
+    // Fall back to default baudrate, if the host did not confirm the new one
+    if (baud_unconfirmed  &&  millis() - baud_confirm_start >= BAUD_CONFIRM_MS)  {
+        Serial.begin(SERIAL_BAUDRATE);
+        baud_unconfirmed = 0;
+    }
+}
+
 void eval_serial_cmd( const char* cmd )
 {
     if (!strncmp( cmd, "trommelbold?", 9 ))  {
+        baud_unconfirmed = 0;
         Serial.println("YESSIR!");
     }
     else if (!strncmp( cmd, "id?", 3 ))  {
+        baud_unconfirmed = 0;
         Serial.println(TROMMELBOLD_ID);
     }
+    else if (!strncmp( cmd, "proto?", 6 ))  {
+        Serial.println("ASCII BIN1 BAUD");
+    }
+    else if (!strncmp( cmd, "baud ", 5 ))  {
+        set_baudrate( atol(cmd+5) );
+    }
     else if (!strncmp( cmd, "mute", 4 )
           || !strncmp( cmd, "mute", 3 ) )  {
         drum.release_all();
@@ -284,6 +363,55 @@ void eval_serial_cmd( const char* cmd )
     }
 }
 
+// Number of argument bytes of binary command <op> with channel mask <mask>
+uint8_t bin_cmd_length( uint8_t op, uint8_t mask )
+{
+    uint8_t n = 0;
+    switch (op)  {
+        case BIN_HIT_DUR:
+            return 2;
+        case BIN_HIT_DURS:
+            for (uint8_t ch=0; ch<N_CHAN; ch++)
+                if (mask & (1<<ch))  n++;
+            return 1 + n;
+        default:
+            return 1;
+    }
+}
+
+void eval_binary_cmd( uint8_t op, const uint8_t* data )
+{
+    uint8_t mask = data[0];
+    const uint8_t* dur = data + 1;
+    for (uint8_t ch=0; ch<N_CHAN; ch++)
+    {
+        if (!(mask & (1<<ch)))  continue;
+        switch (op)  {
+            case BIN_HIT:      serial_hit( ch, drum.def_beat_duration );  break;
+            case BIN_HIT_DUR:  serial_hit( ch, dur[0] ? dur[0] : drum.def_beat_duration );  break;
+            case BIN_HIT_DURS: serial_hit( ch, *dur ? *dur : drum.def_beat_duration );  dur++;  break;
+            case BIN_RELEASE:
+                drum.release( ch );
+                if (USE_MIDI  &&  SERIAL_TO_MIDI)  {
+                    int8_t note = drum_to_midi_note(ch);
+                    if (note >= 0)
+                        MIDI.send( midi::NoteOff, note, 64, 1 );
+                }
+                break;
+        }
+    }
+}
+
+void serial_hit( uint8_t ch, uint16_t ms_duration )
+{
+    drum.hit( ch, ms_duration );
+    if (USE_MIDI  &&  SERIAL_TO_MIDI) {
+        int8_t note = drum_to_midi_note(ch);
+        if (note >= 0)
+            MIDI.send( midi::NoteOn, note, 64, 1 );
+    }
+}
+
 extern "C" void dout( const char* msg, int i)
 {
     Serial.print(msg); Serial.println(i, HEX);
@@ -1,30 +1,103 @@
 
-import pygame, colorsys
+import pygame, colorsys, threading
+from numpy import zeros, roll, random, uint8, int8, int64, arange, asarray, where, clip, unique
 
 def empty_list(shape):
     if len(shape)==1: return [ None for i in range(shape[0]) ]
     else: return [empty_list(shape[1:]) for i in range(shape[0])] 
 
 
+def grid_index(u, size, margin, cluster, n):
+    '''Index of the key at offset <u> along one axis of the layout used by
+    KeyMatrix.place(), None if <u> is in a margin or outside the grid.'''
+    pitch = size + margin                      # key to key
+    cluster_pitch = cluster*pitch + margin//2  # cluster to cluster
+    ic, u = divmod( u, cluster_pitch )
+    i, u = divmod( u, pitch )
+    i += ic*cluster
+    if u >= size or i >= (ic+1)*cluster or not 0 <= i < n: return None
+    return int(i)
+
+
+def pattern_masks(pattern):
+    '''Return list of step masks for <pattern>[step][channel], bit n is channel n.'''
+    nchannels = pattern.shape[1]
+    if nchannels <= 62:
+        return [ int(b) for b in ( (pattern != 0).astype(int64) << arange(nchannels) ).sum(axis=1) ]
+    return [ sum( [1 << c for c in range(nchannels) if row[c]] ) for row in pattern ]
+
+def step_code(mask, velocity, duration):
+    '''Hashable code of a step with channel <mask>, and the <velocity> and
+    <duration> rows of the pattern. Outputs are cached by this code.'''
+    return ( mask, velocity.tostring(), duration.tostring() )
+
+def velocities(m, default=127):
+    '''Map pattern values to velocities: 1 (key on, as in old sequence files)
+    is <default>, other values are clipped to 0-127.'''
+    m = asarray(m)
+    return where( m == 1, default, clip(m, 0, 127) )
+
+
+def tick_codes(steps, pattern, duration, offset):
+    '''Return list of (offset, code) of the keys at steps[channel] of a pattern,
+    grouped by micro timing, see KeyMatrix.tick_codes().'''
+    channels = arange( len(steps) )
+    vel, dur, off = pattern[steps, channels], duration[steps, channels], offset[steps, channels]
+    codes = []
+    for o in unique( off[vel != 0] ):
+        v = where( off == o, vel, 0 ).astype(uint8)
+        codes.append( (o/100., step_code(pattern_masks(v[None])[0], v, dur)) )
+    return codes
+
+
 class colors:
     key_off = [(30,30,30)]*8
     ##key_on = [(150,70,70)]*8
     key_on = [ tuple( int(i*255) for i in colorsys.hsv_to_rgb(c/8., 1.0, 0.5))
                for c in range(8) ]
+    levels = 4   # Active keys are shaded by velocity in this many levels
+
+def velocity_level(velocity):
+    '''Shading level of a key with <velocity>, 0 is off, colors.levels is full velocity.'''
+    return ( int(velocity)*colors.levels + 126 ) // 127
+
+def key_color(channel, level):
+    '''Colour of a key of <channel> at shading <level>, see velocity_level().'''
+    off, on = colors.key_off[channel%8], colors.key_on[channel%8]
+    return tuple( int(a + (b-a)*level/float(colors.levels)) for (a, b) in zip(off, on) )
 
 
-class Key:
-    rect = None
-    color = colors.key_off[0]
-    active = 0
-    step = None
-    channel = None
-    def __init__(self, step=None, channel=None):
+class Key(object):
+    '''Lightweight view on one cell of a KeyMatrix pattern.'''
+    __slots__ = ['matrix', 'step', 'channel', 'rect']
+    def __init__(self, matrix, step=None, channel=None):
+        self.matrix = matrix
         self.step, self.channel = step, channel
+        self.rect = None
+    @property
+    def active(self):
+        '''Velocity of the key, 0 if off.'''
+        return self.matrix.pattern[self.step, self.channel]
+    velocity = active
+    @property
+    def duration(self):
+        '''Trommelbold strike duration in ms, 0 for the firmware default.'''
+        return self.matrix.duration[self.step, self.channel]
+    @property
+    def offset(self):
+        '''Micro timing in percent of a step.'''
+        return self.matrix.offset[self.step, self.channel]
+    @property
+    def color(self):
+        return key_color( self.channel, velocity_level(self.active) )
     def set_active(self, active=1):
-        self.active = active
-        self.color = colors.key_on[self.channel%8] if active \
-                            else colors.key_off[self.channel%8]
+        self.matrix.set_key( self.step, self.channel, active )
+    def set_velocity(self, velocity):
+        self.matrix.set_velocity( self.step, self.channel, velocity )
+    def set_duration(self, duration):
+        self.matrix.set_duration( self.step, self.channel, duration )
+    def set_offset(self, offset):
+        self.matrix.set_offset( self.step, self.channel, offset )
     def toggle_active(self):
         self.set_active( not self.active )
         
@@ -33,15 +106,51 @@ class Key:
 class KeyMatrix:
     nsteps = None
     nchannels = None
+    nbanks = None
+    banks = None    # uint8 array [nbanks,nsteps,nchannels], velocities of all patterns in one block
+    durations = None   # uint8 array [nbanks,nsteps,nchannels], strike durations in ms, 0: default
+    offsets = None     # int8 array [nbanks,nsteps,nchannels], micro timing in percent of a step, -50..50
+    min_offset = 0     # Lowest micro timing in all banks, see update_min_offset()
+    bank_lengths = None   # int array [nbanks,nchannels], number of steps of each channel (polymeter)
+    bank_masks = None  # [nbanks][nsteps] step masks of all banks
+    bank_codes = None  # [nbanks][nsteps] step codes of all banks
+    bank = None     # Current bank
+    pattern = None  # uint8 array [nsteps,nchannels], velocity of all keys, 0 is off. View on banks[bank]
+    duration = None    # uint8 array [nsteps,nchannels], view on durations[bank]
+    offset = None      # int8 array [nsteps,nchannels], view on offsets[bank]
+    lengths = None     # int array [nchannels], view on bank_lengths[bank]
+    step_masks = None  # [nsteps] bitmask of active channels per step, bit n is channel n
+    step_codes = None  # [nsteps] hashable code of each step, see step_code()
+    def_velocity = 127   # Velocity of keys switched on
     steps = None    # [nsteps][nchannels]
     channels = None # [nchannels][nsteps]
     keys = None  # All keys
     beat = None
     surface = None
+    dirty = None       # Set of keys to be redrawn by draw()
+    tiles = None       # Pre-rendered keys [channel%8][velocity level][highlighted], see place()
+    tile_size = None
+    grid = None        # Key layout (x0, y0, w, h, margin, cluster), see place() and key_at()
+    drawn_step = None  # Highlighted step on screen
+    _lock = None       # set_bank() runs on the clock thread, guards the bank views and dirty
 
-    def __init__( self, nsteps=8, nchannels=8 ):
+    def __init__( self, nsteps=8, nchannels=8, nbanks=1 ):
         self.nsteps = nsteps
         self.nchannels = nchannels
+        self.nbanks = nbanks
+        self.banks = zeros( (nbanks, nsteps, nchannels), uint8 )
+        self.durations = zeros( (nbanks, nsteps, nchannels), uint8 )
+        self.offsets = zeros( (nbanks, nsteps, nchannels), int8 )
+        self.bank_lengths = zeros( (nbanks, nchannels), int ) + nsteps
+        self.bank_masks = [ [0]*nsteps for b in range(nbanks) ]
+        self.bank_codes = [ [step_code(0, self.banks[b,s], self.durations[b,s]) for s in range(nsteps)] \
+                                for b in range(nbanks) ]
+        self.bank = 0
+        self.pattern, self.duration = self.banks[0], self.durations[0]
+        self.offset, self.lengths = self.offsets[0], self.bank_lengths[0]
+        self.step_masks, self.step_codes = self.bank_masks[0], self.bank_codes[0]
+        self.dirty = set()
+        self._lock = threading.RLock()
 
         # Create key lists:
         self.steps = empty_list((nsteps,nchannels))     # [step][channel]
@@ -51,7 +160,7 @@ class KeyMatrix:
         # Populate key lists
         for s in range(nsteps):
             for c in range(nchannels):
-                k = Key(s, c)
+                k = Key(self, s, c)
                 self.keys.append(k)
                 self.steps[s][c] = k
                 self.channels[c][s] = k
@@ -77,34 +186,90 @@ class KeyMatrix:
         ## without clusters: h = int( (H-(ny+1)*margin)/ny )  # height
 
         # Place all key rects
+        self.grid = X0+margin, Y0+margin, w, h, margin, cluster
         for k in self.keys:
             x = int( X0+margin + (w+margin)*k.step + margin//2*int(k.step//cluster))
             y = int( Y0+margin + (h+margin)*k.channel + margin//2*int(k.channel//cluster))
             k.rect = x, y, w, h
+
+        # Pre-render keys in all states, only if the size changed
+        if (w, h) != self.tile_size:
+            self.tile_size = w, h
+            self.tiles = [ [ [ self.render_tile(key_color(c, level), highlight) for highlight in (0,1) ] \
+                               for level in range(colors.levels+1) ] \
+                           for c in range(8) ]
+        self.invalidate()
+
+    def render_tile( self, color, highlight=0 ):
+        """Render one key of size <tile_size>, in the pixel format of the surface."""
+        if highlight: color = [min(2*c,255) for c in color]
+        tile = pygame.Surface( self.tile_size, 0, self.surface )
+        tile.fill( color )
+        return tile
             
 
+    def invalidate( self, rect=None ):
+        """Mark keys to be redrawn by the next draw(). If <rect> is given, only
+        the keys overlapping it are marked."""
+        if rect != None:
+            rect = pygame.Rect( rect )
+        with self._lock:
+            if rect == None:
+                self.dirty.update( self.keys )
+            else:
+                self.dirty.update( [k for k in self.keys if k.rect and rect.colliderect(k.rect)] )
+
     def draw( self, step=None ):
-        """Draw keyboard matrix to surface given previously via place()."""
+        """Draw changed keys to surface given previously via place(), and
+        <step> highlighted. Returns list of changed rects, one per step, to be
+        passed to pygame.display.update()."""
 
-        if self.surface == None: return
+        if self.surface == None: return []
 
-        # Draw all key rects
-        for k in self.keys:
-            color = [min(2*c,255) for c in k.color] \
-                      if k.step==step else k.color
-            pygame.draw.rect( self.surface, color, k.rect )    
+        blits = []
+        rects = {}
+        with self._lock:
+            # Highlight moved: redraw the previous and the new step
+            if step != self.drawn_step:
+                if self.drawn_step != None: self.dirty.update( self.steps[self.drawn_step] )
+                if step != None: self.dirty.update( self.steps[step] )
+                self.drawn_step = step
+
+            dirty, self.dirty = self.dirty, set()
+            for k in dirty:
+                if k.rect == None: continue
+                blits.append( (self.tiles[k.channel%8][velocity_level(k.active)][k.step==step], k.rect[:2]) )
+                r = rects.get( k.step )
+                rects[k.step] = r.union(k.rect) if r else pygame.Rect(k.rect)
+        self.surface.blits( blits, 0 )
+        return rects.values()
 
 
-    def click( self, (x,y) ):
+    def key_at( self, (x,y) ):
+        """Return key at screen position (x,y), None if there is none. The key
+        layout of place() is inverted, so this does not depend on the number of keys."""
+        if self.grid == None: return None
+        x0, y0, w, h, margin, cluster = self.grid
+        s = grid_index( x-x0, w, margin, cluster, self.nsteps )
+        c = grid_index( y-y0, h, margin, cluster, self.nchannels )
+        if s == None or c == None: return None
+        return self.steps[s][c]
+
+    def click( self, pos ):
         """Evaluate mouse clicks. If a mouse click is inside a key's area, the key will be toggled.
         The key positions on the screen are determiend by the place function. Prior to the first
         call to place(), the click() function will have no effect"""
-        for k in self.keys:
-            if k.rect==None: continue
-            x0,y0,w,h = k.rect
-            if x >= x0 and x < x0+w and y >= y0 and y < y0+h:
-                k.toggle_active()
-                return k
+        k = self.key_at( pos )
+        if k: k.toggle_active()
+        return k
+
+    def paint( self, pos, active=1 ):
+        """Set key at <pos> to <active>, e.g. while dragging the mouse.
+        Returns the key if it was changed, otherwise None."""
+        k = self.key_at( pos )
+        if k and bool(k.active) != bool(active):
+            k.set_active( active )
+            return k
               
 
 
@@ -114,24 +279,194 @@ class KeyMatrix:
             return self.channels[channel] if channel<self.nchannels else []
         if channel==None:
             return self.steps[step] if step<self.nsteps else []
-        return self.steps[step][channel] if (steps<self.nsteps and channel<nchannels) else []
+        return self.steps[step][channel] if (step<self.nsteps and channel<self.nchannels) else []
 
     def get_matrix( self ):
-        m = [[ chan.active for chan in step] for step in self.steps]
-        return m
+        """Return a copy of the pattern velocities, array [step][channel]"""
+        return self.pattern.copy()
+
+    def get_durations( self ):
+        """Return a copy of the strike durations, array [step][channel]"""
+        return self.duration.copy()
+
+    def get_offsets( self ):
+        """Return a copy of the micro timing, array [step][channel]"""
+        return self.offset.copy()
 
-    def set_matrix( self, m ):
-        for i,step in enumerate(self.steps):
-            for j,key in enumerate(step):
-                try: on = m[i][j]
-                except IndexError: on = 0
-                key.set_active( on )
-                
+    def get_lengths( self ):
+        """Return a copy of the channel lengths, array [channel]"""
+        return self.lengths.copy()
+
+    def get_mask( self, step ):
+        '''Return bitmask of active channels of <step>, bit n is channel n.'''
+        return self.step_masks[step]
+
+    def set_key( self, step, channel, active=1 ):
+        '''Switch key on with <def_velocity>, or off.'''
+        self.set_velocity( step, channel, self.def_velocity if active else 0 )
+
+    def set_velocity( self, step, channel, velocity ):
+        '''Set velocity (0-127) of a key, 0 is off.'''
+        velocity = min( max(int(velocity), 0), 127 )
+        with self._lock:
+            self.pattern[step, channel] = velocity
+            self.dirty.add( self.steps[step][channel] )
+            if velocity: self.step_masks[step] |= 1 << channel
+            else: self.step_masks[step] &= ~(1 << channel)
+            self.update_code( step )
+
+    def set_duration( self, step, channel, duration ):
+        '''Set strike duration of a key in ms (0-255), 0 is the firmware default.'''
+        with self._lock:
+            self.duration[step, channel] = min( max(int(duration), 0), 255 )
+            self.update_code( step )
+
+    def set_offset( self, step, channel, offset ):
+        '''Set micro timing of a key in percent of a step, -50 (early) to 50 (late).'''
+        self.offset[step, channel] = min( max(int(offset), -50), 50 )
+        self.update_min_offset()
+
+    def set_length( self, channel, length ):
+        '''Set number of steps of <channel>, the channel loops over its first
+        <length> steps independently of the others.'''
+        self.lengths[channel] = min( max(int(length), 1), self.nsteps )
+
+    def tick_codes( self, tick, bank=None ):
+        '''Return list of (offset, code) of the keys playing at step number
+        <tick> since start, in the current or the given <bank>. Channel c plays
+        step tick % lengths[c], keys with the same micro timing are grouped into
+        one code, offset is a fraction of a step.'''
+        b = self.bank if bank == None else bank
+        lengths, offset, step = self.bank_lengths[b], self.offsets[b], tick % self.nsteps
+        if not offset[step].any() and (lengths == self.nsteps).all():
+            return [ (0., self.bank_codes[b][step]) ]
+        return tick_codes( tick % lengths, self.banks[b], self.durations[b], offset )
+
+    def update_code( self, step ):
+        self.step_codes[step] = step_code( self.step_masks[step], self.pattern[step], self.duration[step] )
+
+    def update_masks( self ):
+        '''Recompute all step masks and codes from the pattern and mark all keys for
+        redraw. Needs to be called after the pattern array was modified directly.'''
+        with self._lock:
+            self.invalidate()
+            self.step_masks[:] = pattern_masks( self.pattern )
+            for step in range(self.nsteps): self.update_code( step )
+
+    def update_min_offset( self ):
+        '''Recompute min_offset. Needs to be called after the offsets array was
+        modified directly.'''
+        self.min_offset = int( self.offsets.min() )
+
+    def set_bank( self, bank ):
+        '''Make <bank> the current pattern. Nothing is copied, so this can be
+        done between two steps, also from another thread than the GUI.'''
+        with self._lock:
+            self.pattern, self.duration = self.banks[bank], self.durations[bank]
+            self.offset, self.lengths = self.offsets[bank], self.bank_lengths[bank]
+            self.step_masks, self.step_codes = self.bank_masks[bank], self.bank_codes[bank]
+            self.bank = bank
+            self.invalidate()
+
+    def get_banks( self ):
+        '''Return a copy of all patterns, array [bank][step][channel]'''
+        return self.banks.copy()
+
+    def get_bank_durations( self ):
+        '''Return a copy of the strike durations of all patterns, array [bank][step][channel]'''
+        return self.durations.copy()
+
+    def get_bank_offsets( self ):
+        '''Return a copy of the micro timing of all patterns, array [bank][step][channel]'''
+        return self.offsets.copy()
+
+    def get_bank_lengths( self ):
+        '''Return a copy of the channel lengths of all patterns, array [bank][channel]'''
+        return self.bank_lengths.copy()
+
+    def set_banks( self, m, durations=None, offsets=None, lengths=None ):
+        '''Set all patterns from array m[bank][step][channel], and optionally their
+        strike <durations>, micro timing <offsets> and channel <lengths>.
+        Missing banks, steps or channels are cleared.'''
+        self.banks[:] = 0
+        self.durations[:] = 0
+        self.offsets[:] = 0
+        self.bank_lengths[:] = self.nsteps
+        b, n, c = [ min(i, j) for (i, j) in zip(m.shape, self.banks.shape) ]
+        self.banks[:b,:n,:c] = velocities( m[:b,:n,:c], self.def_velocity )
+        if durations is not None:
+            b, n, c = [ min(i, j) for (i, j) in zip(durations.shape, self.durations.shape) ]
+            self.durations[:b,:n,:c] = clip( durations[:b,:n,:c], 0, 255 )
+        if offsets is not None:
+            b, n, c = [ min(i, j) for (i, j) in zip(offsets.shape, self.offsets.shape) ]
+            self.offsets[:b,:n,:c] = clip( offsets[:b,:n,:c], -50, 50 )
+        if lengths is not None:
+            b, c = [ min(i, j) for (i, j) in zip(lengths.shape, self.bank_lengths.shape) ]
+            self.bank_lengths[:b,:c] = clip( lengths[:b,:c], 1, self.nsteps )
+        for b in range(self.nbanks):
+            self.bank_masks[b][:] = masks = pattern_masks( self.banks[b] )
+            self.bank_codes[b][:] = [ step_code(masks[s], self.banks[b,s], self.durations[b,s]) \
+                                          for s in range(self.nsteps) ]
+        self.update_min_offset()
+        self.invalidate()
+
+    def set_matrix( self, m, durations=None, offsets=None, lengths=None ):
+        """Set pattern velocities from m[step][channel], and optionally the strike
+        <durations>, micro timing <offsets> and channel <lengths>. Missing steps
+        or channels are cleared, rows may have different lengths."""
+        with self._lock:
+            self.lengths[:] = self.nsteps
+            if lengths is not None:
+                lengths = clip( lengths[:self.nchannels], 1, self.nsteps )
+                self.lengths[:len(lengths)] = lengths
+            for (a, src, f) in [ (self.pattern, m, lambda v: velocities(v, self.def_velocity)),
+                                 (self.duration, durations, lambda d: clip(d, 0, 255)),
+                                 (self.offset, offsets, lambda o: clip(o, -50, 50)) ]:
+                a[:] = 0
+                if src is None: continue
+                if hasattr(src, 'shape') and len(src.shape) == 2:
+                    n, c = min(src.shape[0], self.nsteps), min(src.shape[1], self.nchannels)
+                    a[:n,:c] = f( src[:n,:c] )
+                else:
+                    for i,row in enumerate(src[:self.nsteps]):
+                        row = f( row[:self.nchannels] )
+                        a[i,:len(row)] = row
+            self.update_masks()
+            self.update_min_offset()
 
     def set_all( self, a ):
-        for i,step in enumerate(self.steps):
-            for j,key in enumerate(step):
-                key.set_active( a )
+        with self._lock:
+            self.pattern[:] = self.def_velocity if a else 0
+            if not a:
+                self.duration[:] = 0
+                self.offset[:] = 0
+                self.update_min_offset()
+            self.update_masks()
+
+    def shift( self, n=1 ):
+        """Rotate pattern by n steps to the right"""
+        with self._lock:
+            self.pattern[:] = roll( self.pattern, n, axis=0 )
+            self.duration[:] = roll( self.duration, n, axis=0 )
+            self.offset[:] = roll( self.offset, n, axis=0 )
+            self.update_masks()
+
+    def randomize( self, density=0.25 ):
+        """Set each key active with probability <density>"""
+        with self._lock:
+            self.pattern[:] = where( random.random_sample( self.pattern.shape ) < density, self.def_velocity, 0 )
+            self.update_masks()
+
+    def copy_steps( self, src, dst, n=1 ):
+        """Copy n steps starting at src to dst. Steps beyond the end are dropped."""
+        n = min( n, self.nsteps-src, self.nsteps-dst )
+        if n <= 0: return
+        with self._lock:
+            self.pattern[dst:dst+n] = self.pattern[src:src+n].copy()
+            self.duration[dst:dst+n] = self.duration[src:src+n].copy()
+            self.offset[dst:dst+n] = self.offset[src:src+n].copy()
+            self.update_masks()
+            self.update_min_offset()
         
 
 
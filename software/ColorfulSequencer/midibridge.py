@@ -0,0 +1,56 @@
+from stepclock import timer
+from timingprobe import TimingProbe
+
+NOTE_ON = 0x90
+
+
+class MidiBridge(object):
+    '''Plays Trommelbold live from MIDI input, e.g. from a keyboard or a DAW.
+
+    Register on_message() and poll() with a MidiIn. Note On messages are
+    mapped to Trommelbold channels by <note_map> {note: channel}, channel 0
+    is Trommelbold channel 1. Notes arriving within <window> seconds of the
+    first one are coalesced into one serial command, sent by the engine, so
+    it is muted with engine.play_trbold. The latency from receiving the
+    first note until the command is written to the port is recorded in
+    <timing>, as its 'serial' field.'''
+
+    enabled = 1
+
+    def __init__(self, engine, note_map, window=0.002, midi_channel=None, timing_probe_size=1024):
+        self.engine = engine
+        self.note_map = note_map
+        self.window = window
+        self.midi_channel = midi_channel   # 1..16, None: all channels
+        self.timing = TimingProbe( timing_probe_size )
+        self.n_notes = 0    # Notes received
+        self.n_hits = 0     # Serial commands sent
+        self._mask = 0      # Channels to hit
+        self._t_first = None  # Receive time of the first note in _mask
+
+    def on_message(self, msg, t):
+        '''Collect one MIDI message <msg> received at time <t>. Called from the input thread.'''
+        status = msg[0]
+        if status & 0xF0 != NOTE_ON or not msg[2]: return   # velocity 0 is a Note Off
+        if self.midi_channel != None and status & 0x0F != self.midi_channel-1: return
+        chan = self.note_map.get( msg[1] )
+        if chan == None or not self.enabled: return
+        if self._t_first == None: self._t_first = t
+        self._mask |= 1 << chan
+        self.n_notes += 1
+
+    def poll(self, t):
+        '''Hit the collected channels, once the window of the first note has passed.
+        Called from the input thread.'''
+        if self._t_first == None or t < self._t_first + self.window: return
+        mask, t_first = self._mask, self._t_first
+        self._mask, self._t_first = 0, None
+        self.timing.new( mask, t_first )   # marked when written, also by the async writer thread
+        if self.engine.send_trbold_mask( mask, None, lambda: self.timing.mark(t_first, 'serial', timer()) ):
+            self.n_hits += 1
+
+    def summary(self):
+        s = self.timing.stats('serial')
+        line = 'bridge   %d notes, %d hits' % (self.n_notes, self.n_hits)
+        if s: line += ', latency p50 %.2f  p99 %.2f  max %.2f ms' % (s['p50'], s['p99'], s['max'])
+        return line
@@ -0,0 +1,121 @@
+from collections import deque
+
+# MIDI real time and system common messages
+CLOCK = 0xF8
+START = 0xFA
+CONTINUE = 0xFB
+STOP = 0xFC
+SONG_POSITION = 0xF2
+
+PPQN = 24   # MIDI clocks per quarter note
+
+
+class ClockPLL(object):
+    '''Phase-locked loop, smoothing the arrival times of periodic clock ticks.
+
+    The first <settle> ticks are averaged, then each tick corrects the
+    predicted phase by <gain> and the period by <freq_gain> of the error.
+    Ticks more than <max_error> periods off the prediction restart the loop,
+    e.g. after the clock source paused.'''
+
+    def __init__(self, gain=0.1, freq_gain=0.003, settle=24, max_error=0.5):
+        self.gain = gain
+        self.freq_gain = freq_gain
+        self.settle = settle
+        self.max_error = max_error
+        self.errors = deque( maxlen=256 )   # Recent phase errors in s
+        self.reset()
+
+    def reset(self):
+        self.t = None       # Smoothed time of the last tick
+        self.t0 = None      # Time of the first tick
+        self.n = 0          # Ticks since first tick
+        self.period = None  # Smoothed tick period in s
+
+    def tick(self, t):
+        '''Feed the measured time <t> of a tick, return its smoothed time.'''
+        if self.t != None and self.period != None:
+            err = t - (self.t + self.period)
+            if abs(err) > self.max_error*self.period: self.reset()
+        if self.t == None:
+            self.t = self.t0 = t
+            return t
+        self.n += 1
+        if self.n <= self.settle:  # Average while settling
+            self.period = (t - self.t0) / self.n
+            self.t = t
+            return t
+        self.errors.append( err )
+        self.t += self.period + self.gain*err
+        self.period += self.freq_gain*err
+        return self.t
+
+    def is_locked(self):
+        return self.n > self.settle
+
+
+class MidiClockSync(object):
+    '''Slaves the sequencer engine to MIDI clock from an input port.
+
+    Register on_message() with a MidiIn. The 24 ppqn clock is smoothed with a
+    ClockPLL, and the step clock is locked to it, with <clocks_per_step> MIDI
+    clocks per step (6 for 16th notes). Start, Stop and Continue control the
+    transport, a Song Position Pointer sets the step to continue at.'''
+
+    clocks_per_step = 6
+
+    def __init__(self, engine, clocks_per_step=6):
+        self.engine = engine
+        self.clocks_per_step = clocks_per_step
+        self.pll = ClockPLL()
+        self.running = 0        # Transport state of the clock source
+        self.position = 0       # Song position in MIDI clocks
+        self._start_pending = 0 # Start with the next clock
+
+    def get_bpm(self):
+        '''Tempo of the clock source in steps per minute, None if unknown.'''
+        if not self.pll.period: return None
+        return 60. / (self.pll.period * self.clocks_per_step)
+
+    def jitter(self):
+        '''Std of the clock arrival times around the smoothed clock, in ms.'''
+        e = list( self.pll.errors )
+        if len(e) < 2: return 0.
+        m = sum(e)/len(e)
+        return 1e3*( sum([(x-m)**2 for x in e])/len(e) )**0.5
+
+    def summary(self):
+        bpm = self.get_bpm()
+        return 'midi clock %s, %s, jitter %.2f ms' % ( ('%.1f BPM' % bpm) if bpm else 'no tempo',
+                   'locked' if self.pll.is_locked() else 'settling', self.jitter() )
+
+    def on_message(self, msg, t):
+        '''Handle one MIDI message <msg> [status, data1, data2, ...] received at time <t>.'''
+        status = msg[0]
+        if status == CLOCK:
+            self._clock(t)
+        elif status == START:
+            self.position = 0
+            self._start_pending = 1
+        elif status == CONTINUE:
+            self._start_pending = 1
+        elif status == STOP:
+            self.running = 0
+            self._start_pending = 0
+            self.engine.stop()
+        elif status == SONG_POSITION:  # in 16th notes
+            self.position = (msg[1] | (msg[2] << 7)) * PPQN/4
+
+    def _clock(self, t):
+        t = self.pll.tick(t)
+        cps = self.clocks_per_step
+        if self._start_pending:  # The first clock after Start/Continue is at the song position
+            self._start_pending = 0
+            self.running = 1
+            tick = -(-self.position // cps)   # positions off the step grid start at the next step
+            self.engine.start( t + (tick*cps - self.position)*(self.pll.period or 0.), tick )
+            return
+        if not self.running: return
+        self.position += 1
+        if self.pll.period:
+            self.engine.sync( t, float(self.position)/cps, self.get_bpm() )
@@ -0,0 +1,63 @@
+import time, threading
+
+from stepclock import timer
+
+
+class MidiIn(object):
+    '''MIDI input port, read by its own thread.
+
+    For every message, the callbacks on_message(msg, t) in <listeners> are
+    called from the input thread, with the message [status, data1, data2, ...]
+    and its receive time t in timer() time base. The callbacks poll(t) in
+    <pollers> are called after each read, and at least every <poll_interval>
+    seconds. PortMidi input can not block, so the thread polls.'''
+
+    device_id = None
+    poll_interval = 0.001
+
+    def __init__(self):
+        self.listeners = []
+        self.pollers = []
+        self._in = None
+        self._thread = None
+        self._quit = 0
+
+    def open(self, device_id):
+        import pygame.midi
+        self.close()
+        self._in = pygame.midi.Input( device_id )
+        self.device_id = device_id
+        self._quit = 0
+        self._thread = threading.Thread(target=self._loop, name='MidiIn')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        if self._thread:
+            self._quit = 1
+            self._thread.join()
+            self._thread = None
+        if self._in: self._in.close()
+        self._in = None
+        self.device_id = None
+
+    def is_open(self):
+        return self._in != None
+
+    def _loop(self):
+        import pygame.midi
+        while not self._quit:
+            try:
+                if self._in.poll():
+                    events = self._in.read( 64 )
+                    # PortMidi timestamps (ms) to timer() time base
+                    t_now, ts_now = timer(), pygame.midi.time()
+                    for (msg, ts) in events:
+                        t = t_now - 1e-3*(ts_now - ts)
+                        for listener in self.listeners: listener( msg, t )
+                else: time.sleep( self.poll_interval )
+                t_now = timer()
+                for poller in self.pollers: poller( t_now )
+            except Exception as ex:
+                print 'Error in midi input: %s' % str(ex)
+                time.sleep( 0.1 )
@@ -0,0 +1,193 @@
+import threading
+from collections import deque, OrderedDict
+
+from stepclock import timer
+from timerwheel import TimerWheel
+
+
+class MidiOut(object):
+    '''MIDI output port, wrapping pygame.midi.Output.
+
+    The open state is kept here, instead of asking PortMidi on every note.
+    Timed messages, from play_at() and queue_events() with times in timer()
+    time base, are kept in a timer wheel. release(), which the owner has to
+    call regularly, writes all messages due within its horizon, sorted by time,
+    in one Output.write() call. So timestamps never go back, which PortMidi on
+    Windows would answer by delaying everything written after. write_now()
+    plays immediately. The time spent in each write is recorded, see get_stats().
+
+    Notes played with play_at() and a gate time get their Note Off queued,
+    too. At most <polyphony> notes sound per MIDI channel, the oldest note is
+    cut when a new one starts. flush() drops what is not yet written and ends
+    all sounding notes.'''
+
+    device_id = None
+    latency = 0     # Output latency in ms, 0: timestamps are ignored by PortMidi
+    polyphony = 16  # Maximum number of sounding notes per MIDI channel
+
+    def __init__(self, latency=0, stats_size=1024):
+        self.latency = latency
+        self.n_writes = 0       # Number of driver calls
+        self.n_events = 0       # Number of messages written
+        self.write_cost = deque( maxlen=stats_size )   # Duration of recent writes in s
+        self.voices = {}        # Sounding notes {MIDI channel: {note: voice id}}, oldest first
+        self.pending = TimerWheel()   # Messages not yet written (n, msg, voice, on_written)
+        self.t_written = 0.     # Latest time written to the driver queue
+        self._ts_written = 0    # Latest PortMidi timestamp written
+        self._voice_id = 0
+        self._n = 0             # Message counter, keeps messages of equal time in order
+        self._lock = threading.Lock()   # Notes are played from the clock and the gui thread
+        self._out = None
+        self._open = False
+
+    def open(self, device_id):
+        import pygame.midi
+        self.close()
+        self._out = pygame.midi.Output( device_id, latency=self.latency )
+        self.device_id = device_id
+        self._open = True
+
+    def close(self):
+        self.flush()
+        if self._open: self._out.close()
+        self._out = None
+        self._open = False
+        self.device_id = None
+
+    def is_open(self):
+        return self._open
+
+    def check(self):
+        '''Ask PortMidi if the device is still open, update open state.'''
+        if not self._open: return False
+        import pygame.midi
+        try: self._open = bool( pygame.midi.get_device_info(self.device_id)[4] )
+        except: self._open = False
+        return self._open
+
+    def write(self, events):
+        '''Write list of [msg, timestamp] in one driver call.'''
+        if not (self._open and events): return False
+        t0 = timer()
+        self._out.write( events )
+        self.write_cost.append( timer() - t0 )
+        self.n_writes += 1
+        self.n_events += len(events)
+        return True
+
+    def write_now(self, msgs):
+        '''Write messages to be played immediately.'''
+        if not (self._open and msgs): return False
+        if self.latency:
+            import pygame.midi
+            ts = pygame.midi.time() - self.latency
+        else: ts = 0
+        with self._lock:  # also written from other threads, PortMidi is not thread safe
+            return self.write( [ [msg, ts] for msg in msgs ] )
+
+    def _timestamps(self, times):
+        '''Convert times in timer() time base to PortMidi timestamps, compensating
+        the output latency. None means immediately.'''
+        if not self.latency: return [0]*len(times)
+        import pygame.midi
+        now = timer()
+        t0 = pygame.midi.time() - self.latency
+        ts = []
+        for t in times:  # never back in time, also not by rounding to ms
+            self._ts_written = max( self._ts_written, t0 + int(1e3*(t - now)) if t != None else t0 )
+            ts.append( self._ts_written )
+        return ts
+
+    def _write_timed(self, events):
+        '''Write list of (t, msg) in one driver call, t in timer() time base.'''
+        if not events: return False
+        ts = self._timestamps( [t for (t, msg) in events] )
+        self.t_written = max( [self.t_written] + [t for (t, msg) in events if t != None] )
+        return self.write( [ [msg, s] for ((t, msg), s) in zip(events, ts) ] )
+
+    def _note_off(self, chan, note):
+        return (0x80 | chan, note, 0)
+
+    def _queue(self, t, msg, voice=None, on_written=None):
+        '''Queue <msg> for time <t>. <voice> (channel, note, id) marks a Note Off,
+        which is dropped if the note was cut or played again meanwhile.'''
+        self._n += 1
+        self.pending.add( t, (self._n, msg, voice, on_written) )
+
+    def _write_due(self, t):
+        '''Write all queued messages due until <t> in one driver call.'''
+        events, callbacks = [], []
+        for (t_msg, (n, msg, voice, on_written)) in self.pending.expire(t):
+            if voice:
+                chan, note, id = voice
+                voices = self.voices.get( chan, {} )
+                if voices.get(note) != id: continue
+                del voices[note]
+            events.append( (t_msg, msg) )
+            if on_written: callbacks.append( on_written )
+        if not (self._open and self._write_timed( events )): return False
+        for on_written in callbacks: on_written()
+        return True
+
+    def play_at(self, msgs, t, gate=None, on_written=None):
+        '''Queue Note On messages <msgs> to be played at time <t>, in timer()
+        time base. With t None, they are written immediately, with all messages
+        due. With <gate> in seconds, Note Offs are queued <gate> after t.
+        on_written() is called when the notes have been written.'''
+        if not (self._open and msgs): return False
+        with self._lock:
+            t_on = t if t != None else timer()
+            for msg in msgs:
+                if gate:
+                    chan, note = msg[0] & 0x0f, msg[1]
+                    voices = self.voices.setdefault( chan, OrderedDict() )
+                    if note in voices:  # retrigger, end the sounding note first
+                        del voices[note]
+                        self._queue( t_on, self._note_off(chan, note) )
+                    while len(voices) >= self.polyphony:  # cut the oldest note
+                        self._queue( t_on, self._note_off(chan, voices.popitem(last=False)[0]) )
+                    self._voice_id += 1
+                    voices[note] = self._voice_id
+                    self._queue( t_on + gate, self._note_off(chan, note), (chan, note, self._voice_id) )
+                self._queue( t_on, msg, None, on_written if msg is msgs[-1] else None )
+            if t == None: return self._write_due( t_on )
+            return True
+
+    def queue_events(self, events):
+        '''Queue list of (t, msg), t in timer() time base.'''
+        if not self._open: return False
+        with self._lock:
+            for (t, msg) in events: self._queue( t, msg )
+            return True
+
+    def release(self, t):
+        '''Write all queued messages due until time <t>, in timer() time base.'''
+        if not len(self.pending): return False
+        with self._lock:
+            return self._write_due( t )
+
+    def flush(self, msgs=[]):
+        '''End all sounding notes, then write <msgs>, after all messages already
+        in the driver queue.'''
+        with self._lock:
+            self.pending.clear()
+            t = max( timer(), self.t_written )
+            events = [ (t, self._note_off(chan, note)) for (chan, voices) in self.voices.items()
+                                                        for note in voices ]
+            events += [ (t, msg) for msg in msgs ]
+            self.voices = {}
+            if not self._open: return False
+            return self._write_timed( events )
+
+    def get_stats(self):
+        '''Return dict with number of writes and messages, and the mean and
+        maximum write duration in ms of recent writes.'''
+        cost = list( self.write_cost )
+        return dict( writes = self.n_writes, events = self.n_events,
+                     mean = 1e3*sum(cost)/len(cost) if cost else 0.,
+                     max = 1e3*max(cost) if cost else 0. )
+
+    def summary(self):
+        s = self.get_stats()
+        return 'midi out %d writes, %d notes, write %.3f ms mean, %.3f ms max' % \
+               (s['writes'], s['events'], s['mean'], s['max'])
@@ -0,0 +1,472 @@
+from numpy import savetxt, savez, load as load_npz, asarray
+
+from stepclock import StepClock, timer
+from timingprobe import TimingProbe
+from keymatrix import KeyMatrix
+from song import Song
+from midiout import MidiOut
+import trbold_com
+
+
+# -----------------------------------------------------------------------------
+# Midi
+# -----------------------------------------------------------------------------
+
+def init_midi():
+    '''Initialize the pygame midi module. Does not need a display.'''
+    import pygame.midi
+    pygame.midi.init()
+
+def list_midi_devices():
+    import pygame.midi
+    devices = []   # Enumerate output devices
+    for id in range(pygame.midi.get_count()):
+        intf, name, inp, outp, op = pygame.midi.get_device_info(id)
+        if outp: devices.append([name,id])
+    return devices
+
+def list_midi_inputs():
+    import pygame.midi
+    devices = []   # Enumerate input devices
+    for id in range(pygame.midi.get_count()):
+        intf, name, inp, outp, op = pygame.midi.get_device_info(id)
+        if inp: devices.append([name,id])
+    return devices
+
+
+# -----------------------------------------------------------------------------
+# Sequencer engine
+# -----------------------------------------------------------------------------
+
+class SequencerEngine(object):
+    '''Sequencer core: pattern state, step clock, tempo and output dispatch
+    to MIDI and Trommelbold. Needs no display, user interfaces are just
+    clients of the engine.
+
+    Clients may register callbacks on_step(step, t) in <step_listeners>. They
+    are called from the step clock thread when a step is due. Hits of the
+    step on the grid are written right after.
+
+    Each step is rendered to a list of hits: channels with the same micro
+    timing are grouped into one hit, and each channel may loop over its own
+    number of steps (polymeter), see KeyMatrix.tick_codes(). The step clock
+    merges the hits of all steps into one timeline and dispatches them in
+    time order.
+
+    MIDI notes end after <midi_gate> steps, and the Note Offs are written by
+    the step clock. All notes are ended when the clock stops. With midi_gate 0,
+    only Note On events are sent, as drum sets do not need Note Offs.
+
+    With <midi_clock_out>, MIDI clock is rendered with the steps, in one
+    timestamped write per step, preceded by Start, or Continue at a song
+    position, and followed by Stop.'''
+
+    SONG_END = 'end'   # Event data marking the end of a song
+    MIDI_CLOCK = 'clock'   # Event data (MIDI_CLOCK, msg) of MIDI clock, when sent without timestamps
+
+    key_matrix = None
+    clock = None
+    song = None     # Song played in song mode, None: loop the current bank
+    timing = None
+    trbold = None
+    midi_out = None
+
+    enable_midi = 1
+    play_midi = 1
+    play_trbold = 1
+    midi_gate = 0.5    # Note length in steps, 0: no Note Off
+    midi_clock_out = 0       # Send MIDI clock and transport messages
+    midi_clocks_per_step = 6   # 24 per quarter note, 6: steps are 16th notes
+
+    def __init__(self, n_steps=16, n_channels=8, bpm=120,
+                 enable_midi=1, midi_channel=10, midi_notes=None,
+                 midi_latency=20, midi_lookahead=0.050,
+                 spin_window=0.002, timing_probe_size=1024, trbold_async=0,
+                 trbold_max_baudrate=None, trbold_reset=True, n_banks=1):
+        self.bpm = bpm
+        self.bank_bpm = [bpm]*n_banks   # Tempo of each bank
+        self.bank_next = None           # Bank to switch to at the next bar
+        self.song_pos = 0        # Index of next song event to render
+        self.song_seek = None    # Bar to continue at, from the next bar on
+        self.song_next = None    # (song, bar) to start at the next bar
+        self.song_loop = 1       # Restart at the end of the song, else stop
+        self.song_ended = 0      # Set when the song stopped at its end
+        self.midi_clock_start = 0  # Send Start or Continue with the next step
+        self.enable_midi = enable_midi
+        self.midi_channel = midi_channel
+        self.midi_notes = midi_notes if midi_notes != None else range(60, 60+n_channels)
+        self.midi_latency = midi_latency
+        self.trbold_max_baudrate = trbold_max_baudrate
+        self.trbold_reset = trbold_reset
+        self.step_listeners = []
+        self._midi_msgs = {}   # Note On messages by step code
+        self.midi_out = MidiOut( midi_latency )
+
+        self.key_matrix = KeyMatrix( n_steps, n_channels, n_banks )
+        self.timing = TimingProbe( timing_probe_size )
+        self.trbold = trbold_com.TrommelboldCom( async_write=trbold_async )
+        if enable_midi: init_midi()
+
+        self.clock = StepClock( n_steps, bpm, self._play_step, spin_window,
+                                self._render_step, midi_lookahead if (enable_midi and midi_latency) else 0. )
+        if enable_midi:
+            self.clock.on_poll = self._poll_midi
+            self.clock.on_stop = self._stop_midi
+
+    # ---- Transport ----------------------------------
+
+    def start(self, t=None, tick=0):
+        '''Start playing. <t> and <tick> are passed to StepClock.start(), e.g.
+        to continue at a song position of an external MIDI clock.'''
+        if self.song_next != None:  # Song started while running, not yet at a bar
+            self.song, bar = self.song_next
+            self.song_next = None
+            self.song_pos = self.song.index(bar)
+        elif self.song != None:  # Song starts over at the next bar, or at the beginning
+            pos = self.song_pos
+            self.song_pos = self.song.index( self.song.events['bar'][pos] ) \
+                                if (pos < len(self.song) and not self.song_ended) else 0
+            self.song_ended = 0
+        self.midi_clock_start = 1
+        self._update_early()
+        if t == None and self.midi_out.t_written > timer():
+            # Start after the messages still queued in the driver, e.g. the Stop of the last run.
+            # PortMidi timestamps are whole ms, keep clear of rounding.
+            t = max( self.midi_out.t_written + 0.002, timer() + self.clock.lookahead + self.clock.early*60./self.bpm )
+        self.clock.start(t, tick)
+
+    def stop(self):
+        self.clock.stop()
+
+    def is_running(self):
+        return self.clock.is_running()
+
+    def get_step(self):
+        '''Current step, None if stopped'''
+        return self.clock.step
+
+    def set_bpm(self, bpm):
+        '''Set tempo of the current bank.'''
+        self.bpm = bpm
+        self.bank_bpm[self.key_matrix.bank] = bpm
+        self.clock.set_bpm(bpm)
+
+    def sync(self, t, tick, bpm):
+        '''Follow an external clock, see StepClock.sync(). The tempo is not
+        stored with the bank.'''
+        self.bpm = bpm
+        self.clock.sync(t, tick, bpm)
+
+    # ---- Banks ----------------------------------
+
+    def get_bank(self):
+        return self.key_matrix.bank
+
+    def select_bank(self, bank):
+        '''Switch to pattern <bank>, with its tempo. While running, the switch
+        is done at the start of the next bar, otherwise immediately.'''
+        if not 0 <= bank < self.key_matrix.nbanks: return
+        if self.is_running():
+            self.bank_next = bank
+        else:
+            self.bank_next = None
+            self._switch_bank(bank)
+
+    # ---- Song mode ----------------------------------
+
+    def play_song(self, song, bar=0):
+        '''Play <song> (a Song or a list of (bank, repeats) entries) from <bar>.
+        The song is compiled from the current patterns and tempi. If already
+        running, the song starts at the next bar.'''
+        if not isinstance(song, Song): song = Song(song)
+        song.compile( self.key_matrix, self.bank_bpm )
+        self.song_ended = 0
+        self.song_seek = None
+        if self.is_running():
+            self.song_next = (song, bar)
+        else:
+            self.song_next = None
+            self.song_pos = song.index(bar)
+            self.song = song
+
+    def stop_song(self):
+        '''Leave song mode, continue looping the current bank.'''
+        self.song_next = None
+        self.song = None
+
+    def seek_bar(self, bar):
+        '''Continue song at <bar>. While running, from the next bar on.'''
+        if self.song == None: return
+        bar = max( 0, min(bar, self.song.n_bars-1) )
+        if self.is_running(): self.song_seek = bar
+        else:
+            self.song_seek = None
+            self.song_pos = self.song.index(bar)
+
+    def skip_bars(self, n):
+        '''Continue song <n> bars after the bar it would continue at, before it
+        for negative n. Repeated calls add up.'''
+        song = self.song
+        if song == None or not len(song): return
+        if self.song_seek != None and self.is_running(): bar = self.song_seek
+        elif self.is_running(): bar = self.get_song_bar() + 1
+        else: bar = int( song.events['bar'][ min(self.song_pos, len(song)-1) ] )
+        self.seek_bar( bar + n )
+
+    def get_song_bar(self):
+        '''Bar of the last rendered song event, None if not in song mode.'''
+        song = self.song
+        if song == None or not len(song): return None
+        return int( song.events['bar'][ max(0, min(self.song_pos, len(song))-1) ] )
+
+    def _render_song(self, seq_step):
+        '''Return hits of the next song event, None past the end of the song.'''
+        song = self.song
+        if seq_step == 0 and self.song_seek != None:
+            self.song_pos = song.index( self.song_seek )
+            self.song_seek = None
+        if self.song_pos >= len(song):
+            if not self.song_loop or not len(song): return None
+            self.song_pos = 0
+        ev = song.events[self.song_pos]
+        self.song_pos += 1
+        if ev['bank'] != self.key_matrix.bank: self.key_matrix.set_bank( int(ev['bank']) )
+        if ev['bpm'] != self.bpm:
+            self.bpm = float(ev['bpm'])
+            self.clock.set_bpm( self.bpm )
+        return ev['hits']
+
+    def set_swing(self, swing):
+        '''Delay every second step, <swing> in percent: 50 is straight, 66.7 triplet feel.'''
+        self.clock.swing = min( max(swing, 50), 75 )
+
+    def _switch_bank(self, bank):
+        self.key_matrix.set_bank(bank)
+        self.bpm = self.bank_bpm[bank]
+        self.clock.set_bpm(self.bpm)
+
+    def quit(self):
+        '''Stop step clock and close all outputs.'''
+        self.clock.quit()
+        self.close_midi()
+        self.trbold.close()
+        if self.enable_midi:
+            import pygame.midi
+            pygame.midi.quit()
+
+    # ---- Pattern ----------------------------------
+
+    def load(self, filename='sequence.dat'):
+        '''Load sequence file: one line per step, one velocity per channel
+        (1: default velocity). Optionally followed by blocks starting with a
+        line '# durations' (strike durations in ms) or '# offsets' (micro timing
+        in percent of a step) in the same layout, and '# lengths' with one
+        line of channel lengths.'''
+        f = open(filename)
+        blocks = {'': []}
+        block = blocks['']
+        for line in f.read().splitlines():
+            if line.startswith('#'): block = blocks.setdefault( line[1:].strip(), [] )
+            elif line.strip(): block.append( [int(d) for d in line.split()] )
+        f.close()
+        lengths = blocks.get('lengths')
+        self.key_matrix.set_matrix( blocks[''], blocks.get('durations'), blocks.get('offsets'),
+                                    lengths[0] if lengths else None )
+
+    def save(self, filename='sequence.dat'):
+        km = self.key_matrix
+        f = open(filename, 'w')
+        savetxt(f, km.get_matrix(), fmt='%d')
+        for (name, a, default) in [ ('durations', km.get_durations(), 0),
+                                    ('offsets', km.get_offsets(), 0),
+                                    ('lengths', km.get_lengths()[None], km.nsteps) ]:
+            if (a != default).any():
+                f.write('# %s\n' % name)
+                savetxt(f, a, fmt='%d')
+        f.close()
+
+    def load_banks(self, filename='banks.npz'):
+        '''Load all banks and their tempi, saved by save_banks().'''
+        f = load_npz(filename)
+        self.key_matrix.set_banks( *[ f[name] if name in f else None for name in
+                                      ['banks', 'durations', 'offsets', 'lengths'] ] )
+        for (bank, bpm) in enumerate( f['bpm'][:len(self.bank_bpm)] ):
+            self.bank_bpm[bank] = int(bpm)
+        self._switch_bank( self.key_matrix.bank )
+        f.close()
+
+    def save_banks(self, filename='banks.npz'):
+        km = self.key_matrix
+        savez(filename, banks=km.get_banks(), bpm=asarray(self.bank_bpm),
+              durations=km.get_bank_durations(), offsets=km.get_bank_offsets(),
+              lengths=km.get_bank_lengths())
+
+    # ---- Midi ----------------------------------
+
+    def open_midi(self, device_id):
+        self.midi_out.open( device_id )
+
+    def close_midi(self):
+        self.midi_out.close()
+
+    def midi_out_is_open(self):
+        return self.enable_midi and self.midi_out.is_open()
+
+    def note_on(self, key, vel):
+        return (0x90+((self.midi_channel-1)&0x0f), key&0x7f, vel&0x7f)
+
+    def program_change(self, prog):
+        return (0xC0+((self.midi_channel-1)&0x0f), prog&0x7f )
+
+    def midi_gate_time(self):
+        '''Note length in s at the current tempo, None for no Note Off.'''
+        return self.midi_gate*60./self.bpm if self.midi_gate else None
+
+    def send_midi(self, chan):
+        if self.play_midi:
+            return self.midi_out.play_at( [self.note_on(self.midi_notes[chan], 127)], None,
+                                          self.midi_gate_time() )
+
+    def midi_msgs(self, code):
+        '''Return list of Note On messages for the active channels of a step,
+        with their velocities. <code> is the step code, see keymatrix.step_code().
+        Messages are cached by code.'''
+        msgs = self._midi_msgs.get( code )
+        if msgs == None:
+            mask, velocity = code[0], code[1]
+            msgs = [ self.note_on(self.midi_notes[chan], ord(velocity[chan])) \
+                         for chan in range(len(self.midi_notes)) if mask & (1 << chan) ]
+            self._midi_msgs[code] = msgs
+        return msgs
+
+    def send_midi_at(self, code, t, on_written=None):
+        """Queue notes of step <code> for a timestamped write.
+        <t> is the desired note time in timer() time base, on_written() is
+        called when the notes have been written."""
+        if self.play_midi and code[0]:
+            return self.midi_out.play_at( self.midi_msgs(code), t, self.midi_gate_time(), on_written )
+
+    def midi_clock_msgs(self, t_grid, dt, tick):
+        '''Render the MIDI clock of one step, at time <t_grid> without swing,
+        step interval <dt> and <tick> steps since start. Returns list of
+        (t, msg), starting with the transport messages at the first step.'''
+        events = []
+        if self.midi_clock_start:
+            self.midi_clock_start = 0
+            if tick:  # Continue at song position, in 16th notes
+                pos = tick*self.midi_clocks_per_step // 6
+                events += [ (t_grid, (0xF2, pos & 0x7f, (pos >> 7) & 0x7f)), (t_grid, (0xFB,)) ]
+            else: events.append( (t_grid, (0xFA,)) )
+        n = self.midi_clocks_per_step
+        events += [ (t_grid + i*dt/n, (0xF8,)) for i in range(n) ]
+        return events
+
+    # ---- Trommelbold ----------------------------------
+
+    def open_trbold(self, portname):
+        return self.trbold.open( portname, max_baudrate=self.trbold_max_baudrate,
+                                 reset=self.trbold_reset )
+
+    def open_trbold_async(self, portname, callback=None, progress=None):
+        '''Open Trommelbold in the background. callback(ok) and progress(msg)
+        are called from the background thread.'''
+        return self.trbold.open_async( portname, callback, max_baudrate=self.trbold_max_baudrate,
+                                       reset=self.trbold_reset, progress=progress )
+
+    def close_trbold(self):
+        self.trbold.close()
+
+    def send_trbold(self, chans):
+        if not chans: return
+        if self.play_trbold and self.trbold.is_connected():
+            self.trbold.hit( chans )
+            return True
+
+    def send_trbold_mask(self, mask, durations=None, on_written=None):
+        '''Hit all channels in bitmask <mask>, bit 0 is Trommelbold channel 1.
+        See TrommelboldCom.hit_mask() for <durations> and <on_written>.'''
+        if not mask: return
+        if self.play_trbold and self.trbold.is_connected():
+            self.trbold.hit_mask( mask, durations, on_written )
+            return True
+
+    def play_key(self, chan):
+        '''Play a single channel immediately, e.g. when a key is clicked.'''
+        if self.enable_midi and self.play_midi: self.send_midi(chan)
+        if self.play_trbold: self.send_trbold(chan+1)
+
+    # ---- Step clock callbacks ----------------------------------
+
+    def _render_step(self, seq_step, t):
+        """Render one step of the sequence ahead of time to timestamped outputs.
+        Called from the step clock thread, <midi_lookahead> seconds before t, or
+        earlier for hits before the step. Returns the hits [(t_hit, code)] for
+        the step clock to dispatch. The codes are kept with the hits, so a bank
+        switch before the hits are due does not change them."""
+        if seq_step == 0 and self.song_next != None:  # Bar boundary
+            song, bar = self.song_next
+            self.song_next = None
+            self.song_pos = song.index(bar)
+            self.song = song
+        if self.song != None:
+            hits = self._render_song( seq_step )
+        else:
+            if seq_step == 0 and self.bank_next != None:  # Bar boundary
+                self._switch_bank( self.bank_next )
+                self.bank_next = None
+            hits = self.key_matrix.tick_codes( self.clock.tick_next )
+        if hits == None: return [ (t, self.SONG_END) ]
+        self._update_early()
+
+        self.timing.new(seq_step, t)
+        dt = 60./self.bpm
+        hits = [ (t + offset*dt, code) for (offset, code) in hits ]
+        if self.enable_midi and self.midi_clock_out and self.midi_out.is_open():
+            clock = self.midi_clock_msgs( self.clock.t_grid, dt, self.clock.tick_next )
+            if self.midi_latency: self.midi_out.queue_events( clock )
+            else: hits = [ (t_clock, (self.MIDI_CLOCK, msg)) for (t_clock, msg) in clock ] + hits
+        if self.enable_midi and self.midi_latency:
+            if self.play_midi:
+                for (t_hit, code) in hits:  # only hits on the grid are recorded
+                    self.send_midi_at( code, t_hit, lambda t_hit=t_hit: self.timing.mark(t_hit, 'midi', timer()) )
+            # Clocks, Note Offs and Note Ons of the step in one write, sorted by time
+            self.midi_out.release( timer() + self.clock.lookahead )
+        return hits
+
+    def _update_early(self):
+        '''Render ahead only as far as needed for hits before their step: keys
+        with negative micro timing, in any bank.'''
+        self.clock.early = max( 0., -self.key_matrix.min_offset / 100. )
+
+    def _play_step(self, seq_step, t, code=None):
+        """Play one step of the sequence, or one hit of it. Called from the step
+        clock thread when the step (code None) or hit is due."""
+        if code == None:
+            self.timing.mark(t, 'dispatch', timer())
+            for listener in self.step_listeners:
+                listener(seq_step, t)
+            return
+        if code == self.SONG_END:
+            self.song_ended = 1
+            self.clock.stop()
+            return
+        if code[0] == self.MIDI_CLOCK:
+            self.midi_out.write_now( [code[1]] )
+            return
+
+        if self.enable_midi and self.play_midi and not self.midi_latency:
+            if code[0] and self.midi_out.play_at( self.midi_msgs(code), None, self.midi_gate_time() ):
+                self.timing.mark(t, 'midi', timer())
+
+        # Trommelbold, the probe is marked when the write is done, also in async mode
+        self.send_trbold_mask( code[0], code[2], lambda: self.timing.mark(t, 'serial', timer()) )
+
+    def _stop_midi(self):
+        '''End all notes, send Stop if MIDI clock was sent. Called from the step clock thread.'''
+        clock_sent = self.midi_clock_out and not self.midi_clock_start
+        self.midi_out.flush( [(0xFC,)] if clock_sent else [] )
+
+    def _poll_midi(self, t):
+        '''Write queued MIDI messages due within the lookahead window. Called from the step clock thread.'''
+        if self.enable_midi:
+            self.midi_out.release( t + self.clock.lookahead )
@@ -13,6 +13,21 @@ bpm = 120  # Beats per minute
 n_steps = 16
 n_channels = 8
 
+# Swing in percent: every second step is delayed, 50 is straight, 66 triplet feel.
+# Press 'w' to step through 50, 58, 66.
+swing = 50
+
+# Pattern banks, select with the Bank buttons or keys 0-9. While playing, the
+# bank is switched at the next bar. Each bank keeps its own tempo.
+# Shift+S / Shift+L save / load all banks to <bank_file>.
+n_banks = 10
+bank_file = 'banks.npz'
+
+# Song mode, toggled with 'm': play banks in this order, (bank, repeats).
+# Page Up / Page Down move the song one bar back / forward, from the next bar on.
+song_arrangement = [ (0, 4), (1, 4), (0, 2), (2, 2) ]
+song_loop = 1
+
 # MIDI settings
 enable_midi = 1   # can be disabled if your system does not support the api
 play_midi = 1
@@ -24,17 +39,61 @@ shift_notes = 0
 midi_notes = [ 60, 62, 64, 65, 67, 69, 71, 72,  60+12, 62+12, 64+12, 65+12, 67+12, 69+12, 71+12, 72+12 ]
 midi_notes = [n + shift_notes for n in midi_notes]
 midi_def_device = 1  # On my Macbook: Internal wavetable synth
+midi_gate = 0.5      # Note length in steps, for melodic sounds. 0: no Note Off, fine for a drumset
+midi_polyphony = 16  # Maximum number of sounding notes, the oldest note is cut
+midi_clock_out = 0   # Send MIDI clock, start and stop, so other gear can follow. See midi_clocks_per_step
 
 # Trommelbold via serial port
 play_trbold = 1
-trbold_def_port = 'COM6'
+trbold_def_port = 'COM6'   # 'sim://' for the software emulation, see trbold_sim.py
+trbold_last_port = 1   # try last known-good port first, instead of trbold_def_port
+trbold_discover = 1    # if neither is available, probe all ports. Press 'p' to probe again
+trbold_reset = 0   # reset Arduino on connect. If 0, a running board answers immediately
+trbold_async = 1   # write to serial port from a background thread, never blocks the step clock
+trbold_max_baudrate = 115200   # raise baudrate up to this, if supported by firmware. None: keep 19200
 
 # Audio output
 play_click = 0
 
-# Desired repetition interval for main loop
+# Desired repetition interval for main loop (event handling)
 main_dt = 0.005
 
+# Maximum screen update rate. The screen is only redrawn at these deadlines,
+# and only if something changed. Press 't' to see frames rendered and skipped.
+max_fps = 60
+
+# The step clock runs in its own thread. It sleeps until <clock_spin_window>
+# seconds before the next beat, and busy waits for the rest.
+clock_spin_window = 0.002
+
+# MIDI events are rendered <midi_lookahead> seconds ahead of time and passed
+# to the driver with timestamps, so the driver, not python, decides the exact
+# note time. The MIDI output is opened with a latency of <midi_latency> ms,
+# which must not exceed the lookahead. Set midi_latency = 0 to send notes
+# immediately when a step is due (timestamps are ignored by PortMidi then).
+midi_lookahead = 0.050
+midi_latency = 20
+
+# MIDI input, for clock sync and the live bridge
+midi_in_device = 0
+
+# MIDI clock input: follow tempo and transport (start, stop, continue, song
+# position) of a DAW or drum machine. The 24 ppqn clock is smoothed by a
+# phase-locked loop, see midiclock.py.
+midi_sync = 0              # Set to 1 to slave to the MIDI clock on <midi_in_device>
+midi_clocks_per_step = 6   # 6: steps are 16th notes, also for the clock output
+
+# Live bridge: notes on <midi_in_device> hit Trommelbold, see midibridge.py.
+# Notes within <midi_bridge_window> seconds are sent as one serial command.
+midi_bridge = 0
+midi_bridge_notes = None     # {note: channel}, channel 0 is Trommelbold channel 1. None: midi_notes
+midi_bridge_window = 0.002
+
+# Timing diagnostics: number of steps kept in the timing probe ring buffer.
+# Press 't' to toggle the live timing overlay, 'd' to dump to timing.csv
+timing_probe_size = 1024
+show_timing = 0
+
 
 #--------------------------------------------------------------------------
 # Modules
@@ -43,8 +102,98 @@ main_dt = 0.005
 import time, os, sys
 from numpy import *
 
-if sys.platform == 'win32': timer = time.clock  # on windows, clock() is the high precision wall time
-else: timer = time.time  # on linux, clock() is the cpu time, while time() is the high accuray wall time
+from stepclock import timer  # high precision wall time, see stepclock.py
+
+# Command line: sequencer.py [--headless] [sequence file]
+headless = '--headless' in sys.argv[1:]
+seq_args = [a for a in sys.argv[1:] if not a.startswith('--')]
+seq_file = (seq_args + ['sequence.dat'])[0]
+
+# -----------------------------------------------------------------------------
+# Sequencer engine: pattern, step clock and outputs. Needs no display.
+# -----------------------------------------------------------------------------
+
+from seqengine import SequencerEngine, list_midi_devices, list_midi_inputs
+
+engine = SequencerEngine( n_steps, n_channels, bpm,
+                          enable_midi, midi_channel, midi_notes,
+                          midi_latency, midi_lookahead,
+                          clock_spin_window, timing_probe_size, trbold_async,
+                          trbold_max_baudrate, trbold_reset, n_banks )
+engine.play_midi = play_midi
+engine.midi_gate = midi_gate
+engine.midi_out.polyphony = midi_polyphony
+engine.midi_clock_out = midi_clock_out
+engine.midi_clocks_per_step = midi_clocks_per_step
+engine.play_trbold = play_trbold
+engine.song_loop = song_loop
+engine.set_swing( swing )
+key_matrix = engine.key_matrix
+timing = engine.timing
+
+# Midi
+if enable_midi:
+    if midi_def_device in [id for (name,id) in list_midi_devices()]:
+        engine.open_midi(midi_def_device)
+
+# Midi input: clock sync and live bridge
+midi_in = None
+clock_sync = None
+bridge = None
+if enable_midi and (midi_sync or midi_bridge):
+    if midi_in_device in [id for (name,id) in list_midi_inputs()]:
+        from midiin import MidiIn
+        midi_in = MidiIn()
+        if midi_sync:
+            from midiclock import MidiClockSync
+            clock_sync = MidiClockSync( engine, midi_clocks_per_step )
+            midi_in.listeners.append( clock_sync.on_message )
+        if midi_bridge:
+            from midibridge import MidiBridge
+            notes = midi_bridge_notes or dict( [ (note, chan) for (chan, note) in enumerate(midi_notes[:n_channels]) ] )
+            bridge = MidiBridge( engine, notes, midi_bridge_window )
+            midi_in.listeners.append( bridge.on_message )
+            midi_in.pollers.append( bridge.poll )
+        midi_in.open( midi_in_device )
+    else: print 'Midi input %s not found' % midi_in_device
+
+# Trommelbold via serial. Opened below: in the background when running with GUI.
+import trbold_com
+trbold = engine.trbold
+trbold_ports = trbold_com.list_ports()
+trbold_port = (trbold_last_port and trbold_com.get_last_port()) or trbold_def_port
+if not (trbold_port in trbold_ports or trbold_port.startswith('sim://')):
+    trbold_port = None
+
+# Load startup sequence. Saved banks are restored, unless a sequence file is given.
+if os.path.exists( bank_file ) and not seq_args:
+    try: engine.load_banks( bank_file )
+    except: print 'Error loading banks'
+else:
+    try: engine.load( seq_file )
+    except: print 'Error loading sequence'
+
+# -----------------------------------------------------------------------------
+# Headless mode: play the sequence without display, until Ctrl-C
+# -----------------------------------------------------------------------------
+
+if headless:
+    if not trbold_port and trbold_discover:
+        found = trbold_com.discover()
+        if found: trbold_port = found[0][0]
+    if trbold_port: engine.open_trbold( trbold_port )
+    if bridge: print 'Playing midi input live, press Ctrl-C to stop'
+    else: print 'Playing %s headless, press Ctrl-C to stop' % seq_file
+    if not (clock_sync or bridge): engine.start()  # else started by the midi clock
+    try:
+        while 1: time.sleep(0.5)
+    except KeyboardInterrupt: pass
+    finally:
+        if midi_in: midi_in.close()
+        if bridge: print bridge.summary()
+        engine.quit()
+    sys.exit()
+
 
 #--------------------------------------------------------------------------
 # Pygame
@@ -66,56 +215,7 @@ screen.fill((0,0,0))
 pygame.display.flip()
 
 font_normal = pygame.font.SysFont('default', 30)
-
-
-# -----------------------------------------------------------------------------
-# Midi
-# -----------------------------------------------------------------------------
-
-if enable_midi:
-    import pygame.midi
-    pygame.midi.init()
-    midi_out = None
-
-    def list_midi_devices():
-        devices = []   # Enumerate output devices 
-        for id in range(pygame.midi.get_count()):
-            intf, name, inp, outp, op = pygame.midi.get_device_info(id)
-            if outp: devices.append([name,id])
-        return devices
-            
-    midi_devices = list_midi_devices()        
-    if midi_def_device in [id for (name,id) in midi_devices]:
-        midi_out = pygame.midi.Output(midi_def_device)
-
-    def midi_out_is_open():
-        try:
-            return pygame.midi.get_device_info(midi_out.device_id)[4]
-        except: return False
-
-    Note_On = lambda key, vel: (0x90+((midi_channel-1)&0x0f), key&0x7f, vel&0x7f)
-    Program_Change = lambda prog: (0xC0+((midi_channel-1)&0x0f), prog&0x7f )
-
-    def send_midi( chan ):
-        if play_midi and midi_out_is_open():
-            midi_out.write_short( *Note_On(midi_notes[chan], 127) )
-
-
-
-# -----------------------------------------------------------------------------
-# Trommelbold via serial
-# -----------------------------------------------------------------------------
-
-import trbold_com
-trbold = trbold_com.TrommelboldCom()
-trbold_ports = trbold_com.list_ports()
-if trbold_def_port in trbold_ports:
-    trbold.open( trbold_def_port )
-
-def send_trbold( chans ):
-    if not chans: return
-    if play_trbold and trbold.is_open():
-            trbold.hit( chans )
+font_small = pygame.font.SysFont('monospace', 14)
 
 
 # -----------------------------------------------------------------------------
@@ -125,6 +225,13 @@ def send_trbold( chans ):
 tick = pygame.mixer.Sound('snd/tick.wav')
 tack = pygame.mixer.Sound('snd/tack.wav')
 
+def play_click_step(seq_step, t):
+    if play_click:
+        if seq_step%8==0: tick.play()
+        else: tack.play()
+
+engine.step_listeners.append( play_click_step )
+
 
 #--------------------------------------------------------------------------
 # Gui widgets
@@ -148,6 +255,8 @@ def on_slider_bpm(_widget):
     global bpm
     slider_bpm_label.set_text( "%d BPM" % int(_widget.value) )
     bpm = int(_widget.value)
+    if clock_sync and clock_sync.running: return  # tempo follows the midi clock
+    engine.set_bpm(bpm)
 
 slider_bpm_label = pgui.Label("%d BPM" %bpm , font=font_normal, color=(230,230,230))
 slider_bpm = pgui.HSlider(value=120, min=30, max=900, size=32, width=300, height=20 )
@@ -159,15 +268,13 @@ gui_cnt.add(slider_bpm,       W-30-300, 50)
 # ---- MIDI-Out select box ----------------------------------
 if enable_midi:
     def on_select_midi(_widget):
-        global midi_out
         seq_stop()
         if _widget.value != 'None':
             print 'Select midi output:', _widget.value
-            if midi_out_is_open(): midi_out.close()
-            midi_out = pygame.midi.Output( _widget.value )
+            engine.open_midi( _widget.value )
         else:
             print 'Close midi output'
-            midi_out.close()
+            engine.close_midi()
         
     def select_midi_fill(select_midi, crop=1):
         select_midi.clear()
@@ -175,8 +282,8 @@ if enable_midi:
         ##for (name, id) in midi_devices:      # uses midi device lst assembled at program start
         for (name, id) in list_midi_devices():  # uses currently available devices
             select_midi.add( str(id)+': '+name.replace('Microsoft ','')[:13], id)
-        if midi_out_is_open():
-            select_midi.value = midi_out.device_id
+        if engine.midi_out_is_open():
+            select_midi.value = engine.midi_out.device_id
         else: select_midi.value = 'None'
                             
     select_midi_label = pgui.Label("MIDI" , font=font_normal, color=(230,230,230))
@@ -185,13 +292,12 @@ if enable_midi:
     select_midi.connect(pgui.CHANGE, on_select_midi)
 
     def on_switch_midi(_widget):
-        global play_midi
         if (_widget.value):
             print 'Play MIDI on'
-            play_midi = 1
+            engine.play_midi = 1
         else:
             print 'Play MIDI off'
-            play_midi = 0
+            engine.play_midi = 0
     switch_midi = pgui.Switch()
     switch_midi.connect(pgui.CHANGE, on_switch_midi)
     if play_midi: switch_midi.value = 1
@@ -202,14 +308,26 @@ if enable_midi:
 
 
 # ---- Trommelbold serial out select box ------------------------------
+# The port is opened in the background. Progress and result are posted as
+# pygame events, and handled in the main loop.
+def on_trbold_progress(msg):
+    pygame.event.post( pygame.event.Event(pygame.USEREVENT, trbold_progress=msg) )
+
+def on_trbold_opened(ok):
+    pygame.event.post( pygame.event.Event(pygame.USEREVENT, trbold_opened=ok) )
+
+def on_trbold_discovered(found):
+    pygame.event.post( pygame.event.Event(pygame.USEREVENT, trbold_found=found) )
+
 def on_select_trbold_change(_widget):
+    if _widget.value == trbold.portname and trbold.is_connected(): return
     seq_stop()
     if _widget.value != 'None':
         print 'Select Trommelbold on port', _widget.value
-        trbold.open(_widget.value)
+        engine.open_trbold_async(_widget.value, on_trbold_opened, on_trbold_progress)
     else:
         print 'Close Trommelbold'
-        trbold.close()
+        engine.close_trbold()
         
 def select_trbold_fill(select_trbold):
     select_trbold.clear()
@@ -217,8 +335,10 @@ def select_trbold_fill(select_trbold):
     ##for p in trbold_ports: select_trbold.add(p,p)  # uses trbold list assembled at program start
     for p in trbold_com.list_ports():   # uses currently available ports
         p = str(p)
-        select_trbold.add(p,p) 
-    if trbold.is_open():
+        name = trbold_com.get_discovered(p)   # id string, if found by discover()
+        select_trbold.add(p + (' '+name if name else ''), p)
+    select_trbold.add('Simulator','sim://')
+    if trbold.is_connected():
         select_trbold.value = trbold.portname
     else: select_trbold.value = 'None'
     
@@ -228,26 +348,30 @@ select_trbold_fill( select_trbold )
 select_trbold.connect(pgui.CHANGE, on_select_trbold_change)
 
 def on_switch_trbold_change(_widget):
-    global play_trbold
     if (_widget.value):
         print 'Play Trommelbold on'
-        play_trbold = 1
+        engine.play_trbold = 1
     else:
         print 'Play Trommelbold off'
-        play_trbold = 0
+        engine.play_trbold = 0
 switch_trbold = pgui.Switch()
 switch_trbold.connect(pgui.CHANGE, on_switch_trbold_change)
 if play_trbold: switch_trbold.value = 1
 
+trbold_status = pgui.Label(" "*40, font=font_small, color=(150,150,150))
+
 gui_cnt.add(select_trbold_label, W-30-630, 55+3)
 gui_cnt.add(switch_trbold,       W-30-555, 55+3)
 gui_cnt.add(select_trbold,       W-30-530, 55)
+gui_cnt.add(trbold_status,       W-30-530, 80)
+
+if trbold_port: engine.open_trbold_async(trbold_port, on_trbold_opened, on_trbold_progress)
+elif trbold_discover: trbold_com.discover_async(on_trbold_discovered)
 
 
 # ---- Run/Stop-Button ------------------------------
 
 def on_button_run(_widget):
-    global seq_run
     if seq_run: seq_stop()
     else:       seq_start()
     
@@ -291,20 +415,24 @@ box_filename = pgui.Input(value="Hello there", width = 160, height = 18)
 gui_cnt.add( box_filename, 220, 25 )
 
 
-### ---- Bank select-Radio buttons ------------------------------
-##
-##radio_bank_label = pgui.Label("Bank" , font=font_normal, color=(230,230,230))
-##group_bank = pgui.Group(name='bank_select', value=0)
-##table_bank = pgui.Table(width=200, height=20)
-##table_bank.tr()
-##for i in range(10):
-##    if i%5 == 0:
-##        table_bank.td( pgui.Spacer(width=10, height=20) )
-##    table_bank.td( pgui.Radio(group_bank, i) )
-##    
-##
-##gui_cnt.add( radio_bank_label, 420, 25 )
-##gui_cnt.add( table_bank, 420, 55 )
+# ---- Bank select-Radio buttons ------------------------------
+
+def on_group_bank(_widget):
+    engine.select_bank( _widget.value )
+
+radio_bank_label = pgui.Label("Bank" , font=font_normal, color=(230,230,230))
+group_bank = pgui.Group(name='bank_select', value=engine.get_bank())
+group_bank.connect(pgui.CHANGE, on_group_bank)
+table_bank = pgui.Table(width=200, height=20)
+table_bank.tr()
+for i in range(min(n_banks, 10)):
+    if i%5 == 0:
+        table_bank.td( pgui.Spacer(width=10, height=20) )
+    table_bank.td( pgui.Radio(group_bank, i) )
+    
+
+gui_cnt.add( radio_bank_label, 420, 25 )
+gui_cnt.add( table_bank, 420, 55 )
 
 
 gui.init( gui_cnt, screen )
@@ -313,46 +441,37 @@ gui.init( gui_cnt, screen )
 # Keyboard matrix
 # -----------------------------------------------------------------------------
 
-from keymatrix import KeyMatrix
-
-key_matrix = KeyMatrix( n_steps, n_channels )
 ##key_matrix.place( screen, screen.get_rect() )
 key_matrix.place( screen, (0, H1, W, H-H1) )
 
-# -----------------------------------------------------------------------------
-# Load startup sequence
-# -----------------------------------------------------------------------------
-
-def load_matrix(filename='sequence.dat'):
-    f = open(filename)
-    m = [ [int(d) for d in line.split()] for line in  f.read().splitlines() ]
-    key_matrix.set_matrix( m )
-    f.close()
-
-try: load_matrix()
-except: print 'Error loading sequence'
-
 # -----------------------------------------------------------------------------
 # Main loop state
 # -----------------------------------------------------------------------------
 
 main_run = 1           # Set to 0 in main loop to terminate program
-main_t_next = None     # Timestamp of next main loop iteration
 
 seq_run = 0         # Set to 1 to start sequencer, set to 0 to stop sequencer.
-seq_running = 0     # Flags that the sequencer is actually running. Do NOT modify maually!
-
-seq_step = None   # Current beat step in sequence
-seq_t_next = None # Timestamp of next beat in sequence
-
 
 def seq_start():
     global seq_run
-    if not seq_run: seq_run = 1; button_run.value = 'Stop'
+    if not seq_run: seq_run = 1; button_run.value = 'Stop'; engine.start()
 
 def seq_stop():
     global seq_run
-    if seq_run: seq_run = 0; button_run.value = 'Play'
+    if seq_run: seq_run = 0; button_run.value = 'Play'; engine.stop()
+
+repaint = 1         # Set to 1 to redraw the whole screen
+changed = 1         # Set to 1 to redraw at the next frame deadline
+timing_rect = None  # Screen area of the timing overlay
+drag_active = None  # While dragging the mouse, keys are set to this state
+shown_bank = engine.get_bank()
+shown_sync_run = 0  # Transport state of the midi clock shown
+timing_count = 0    # Number of timing records shown in overlay
+
+t_frame = timer()   # Deadline of next frame
+t_frame_stats = t_frame
+frames = [0, 0]       # Frames rendered, skipped in the current second
+frame_stats = [0, 0]  # Frames rendered, skipped in the last second
 
 # -----------------------------------------------------------------------------
 # Main loop 
@@ -369,89 +488,176 @@ try:
                    event.key == pygame.K_ESCAPE:
                     main_run = 0
                 elif event.key == pygame.K_SPACE:
-                    if seq_run: seq_run = 0
-                    else: seq_run = 1
+                    if seq_run: seq_stop()
+                    else: seq_start()
+                elif event.key == pygame.K_s and event.mod & pygame.KMOD_SHIFT:
+                    print 'Save banks'
+                    engine.save_banks( bank_file )
+                elif event.key == pygame.K_l and event.mod & pygame.KMOD_SHIFT:
+                    print 'Load banks'
+                    try: engine.load_banks( bank_file )
+                    except: print 'Error loading banks'
                 elif event.key == pygame.K_s:
                     print 'Save sequence'
-                    savetxt('sequence.dat', key_matrix.get_matrix(), fmt='%d')
+                    engine.save( seq_file )
                 elif event.key == pygame.K_l:
                     print 'Load sequence' 
-                    try: key_matrix.set_matrix( loadtxt('sequence.dat', dtype=int) )
+                    try: engine.load( seq_file )
                     except: print 'Error loading sequence'
                 elif event.key == pygame.K_c:
                     key_matrix.set_all(0)
+                elif event.key == pygame.K_r:
+                    key_matrix.randomize()
+                elif event.key == pygame.K_RIGHT:
+                    key_matrix.shift(1)
+                elif event.key == pygame.K_LEFT:
+                    key_matrix.shift(-1)
+                elif event.key == pygame.K_p:
+                    print 'Probe ports for Trommelbold'
+                    trbold_status.set_text('Probing ports ...')
+                    trbold_com.discover_async(on_trbold_discovered, refresh=True,
+                                              exclude=[trbold.portname] if trbold.is_connected() else [])
+                elif event.key == pygame.K_m:
+                    if engine.song == None and engine.song_next == None:
+                        print 'Song mode'
+                        engine.play_song( song_arrangement )
+                    else:
+                        print 'Pattern mode'
+                        engine.stop_song()
+                elif event.key == pygame.K_PAGEUP:
+                    engine.skip_bars( -1 )
+                elif event.key == pygame.K_PAGEDOWN:
+                    engine.skip_bars( 1 )
+                elif pygame.K_0 <= event.key <= pygame.K_9:
+                    group_bank.value = event.key - pygame.K_0
+                elif event.key == pygame.K_w:
+                    swing = {50: 58, 58: 66}.get(swing, 50)
+                    print 'Swing %d%%' % swing
+                    engine.set_swing( swing )
+                elif event.key == pygame.K_t:
+                    show_timing = not show_timing
+                elif event.key == pygame.K_d:
+                    print 'Dump timing to timing.csv'
+                    timing.dump_csv('timing.csv')
+                    for line in timing.summary(): print line
+                    print 'frames: %d/s rendered, %d/s skipped' % tuple(frame_stats)
+                    if engine.midi_out_is_open(): print engine.midi_out.summary()
+                    if clock_sync: print clock_sync.summary()
+                    if bridge: print bridge.summary()
             elif event.type == pygame.QUIT:
                 main_run = 0
             elif event.type == pygame.MOUSEMOTION:
-                pass
+                if drag_active != None:  # Paint keys while dragging
+                    key = key_matrix.paint(event.pos, drag_active)
+                    if key and drag_active:
+                        engine.play_key( key.channel )
+            elif event.type == pygame.MOUSEBUTTONDOWN and event.button in (4, 5):
+                # Mouse wheel: velocity of active keys, with shift the strike duration,
+                # with ctrl the micro timing
+                key = key_matrix.key_at(event.pos)
+                step = 1 if event.button == 4 else -1
+                if key and key.active:
+                    if pygame.key.get_mods() & pygame.KMOD_SHIFT:
+                        key.set_duration( key.duration + 5*step )
+                        print 'Duration %d ms' % key.duration
+                    elif pygame.key.get_mods() & pygame.KMOD_CTRL:
+                        key.set_offset( key.offset + 5*step )
+                        print 'Offset %d%%' % key.offset
+                    else:
+                        key.set_velocity( max(15, key.velocity + 16*step) )
+            elif event.type == pygame.MOUSEBUTTONDOWN and pygame.key.get_mods() & pygame.KMOD_CTRL:
+                # Ctrl+click: channel loops over the steps up to here, again for all steps
+                key = key_matrix.key_at(event.pos)
+                if key:
+                    length = key.step+1 if key_matrix.lengths[key.channel] != key.step+1 else n_steps
+                    key_matrix.set_length( key.channel, length )
+                    print 'Channel %d: %d steps' % (key.channel+1, length)
             elif event.type == pygame.MOUSEBUTTONDOWN:
                 ##print 'Mouse down at', event.pos
                 key = key_matrix.click(event.pos)
                 if key:
-                    if enable_midi and play_midi: send_midi(key.channel)
-                    if play_trbold:
-                        send_trbold( key.channel+1 )
-                        ##print 'trbold:', key.channel+1
+                    drag_active = key.active
+                    engine.play_key( key.channel )
             elif event.type == pygame.MOUSEBUTTONUP:
                 ##print 'Mouse up at', event.pos
-                pass
+                drag_active = None
+            elif event.type == pygame.USEREVENT:
+                if hasattr(event, 'trbold_progress'):
+                    trbold_status.set_text( event.trbold_progress[:40] )
+                if hasattr(event, 'trbold_opened'):
+                    select_trbold_fill(select_trbold)
+                if hasattr(event, 'trbold_found'):
+                    print 'Found Trommelbold:', event.trbold_found
+                    trbold_status.set_text( 'Found %d Trommelbold' % len(event.trbold_found) )
+                    select_trbold_fill(select_trbold)
+                    if event.trbold_found and not trbold.is_connected():
+                        engine.open_trbold_async(event.trbold_found[0][0], on_trbold_opened, on_trbold_progress)
 
             # pass event to gui
             gui.event(event)
+            changed = 1
 
         if not main_run: break
 
-
-        # Sequence
-        if seq_run and not seq_running:  # Sequencer is to be started
-            seq_running = 1
-            seq_t_next = timer()
-            seq_step = -1
-
-        if not seq_run and seq_running:  # Sequencer is to be stopped
-            seq_running = 0
-            
-        if seq_running and timer() >= seq_t_next:
-            seq_step += 1
-            seq_step %= n_steps
-            ##print seq_step, '  +%d ms' % int(1e3*(timer()-seq_t_next))
-            seq_t_next +=  60./bpm  # time of next beat
-
-            if play_click:
-                if seq_step%8==0: tick.play()
-                else: tack.play()
-            
-            if enable_midi and play_midi:
-                # For a drum set, we only send Note On events
-                for key in key_matrix.get_keys(seq_step):
-                    if key.active:
-                        send_midi( key.channel )
-
-            # Trommelbold
-            if play_trbold:
-                trbold_chans = \
-                    [ n+1 for (n,key) in enumerate( key_matrix.get_keys(seq_step) ) \
-                         if key.active ]
-                send_trbold( trbold_chans )
-                print 'trbold:', trbold_chans
-            
-                        
-        # Screen
-        screen.fill((0,0,0))
-        key_matrix.draw(seq_step)
-        gui.paint(screen)
-        pygame.display.flip()
+        if engine.song_ended:
+            engine.song_ended = 0
+            seq_stop()
+
+        # Bank switched by the step clock, show its tempo
+        if engine.get_bank() != shown_bank:
+            shown_bank = engine.get_bank()
+            slider_bpm.value = engine.bpm
+            changed = 1
+
+        # Started or stopped by the midi clock, show transport and tempo
+        if clock_sync:
+            if clock_sync.running != shown_sync_run:
+                shown_sync_run = seq_run = clock_sync.running
+                button_run.value = 'Stop' if seq_run else 'Play'
+            if clock_sync.running and int(engine.bpm) != int(slider_bpm.value):
+                slider_bpm.value = engine.bpm
+
+        # Screen. Beats are played by the step clock thread, independently of rendering.
+        # Redraw at frame deadlines only, and skip the frame if nothing changed.
+        t = timer()
+        if t >= t_frame:
+            t_frame = max( t_frame + 1./max_fps, t )
+            step = engine.get_step()
+            if changed or repaint or key_matrix.dirty or step != key_matrix.drawn_step or \
+               (show_timing and timing.count != timing_count) or (timing_rect and not show_timing):
+                changed = 0
+                frames[0] += 1
+                # Only changed areas are updated, any gui change repaints the whole screen.
+                rects = gui.update(screen) or []
+                if rects or repaint:
+                    repaint = 0
+                    screen.fill((0,0,0))
+                    gui.paint(screen)
+                    key_matrix.invalidate()
+                    rects = [screen.get_rect()]
+                if timing_rect:  # clear timing overlay, redraw keys below
+                    screen.fill((0,0,0), timing_rect)
+                    key_matrix.invalidate(timing_rect)
+                    rects.append(timing_rect)
+                    timing_rect = None
+                rects += key_matrix.draw(step)
+                if show_timing:
+                    timing_count = timing.count
+                    extra = ['frames   %d/s rendered, %d/s skipped, max %d fps' % tuple(frame_stats + [max_fps])]
+                    if engine.midi_out_is_open(): extra.append( engine.midi_out.summary() )
+                    if clock_sync: extra.append( clock_sync.summary() )
+                    if bridge: extra.append( bridge.summary() )
+                    timing_rect = timing.draw(screen, font_small, (30, H-90), extra=extra)
+                    rects.append(timing_rect)
+                pygame.display.update(rects)
+            else: frames[1] += 1
+            if t - t_frame_stats >= 1.:
+                t_frame_stats, frame_stats, frames = t, frames, [0, 0]
 
 
         # Main loop clock
-        if seq_running:
-            if main_t_next == None: main_t_next = timer()
-            main_t_next += main_dt
-            while timer() < main_t_next:
-                if timer()<main_t_next-0.02:
-                    pass
-                    ##time.sleep(0.001)
-                else: pass
+        if engine.is_running():
+            time.sleep(main_dt)
         else:  # not running
             time.sleep(0.010)
                 
@@ -460,8 +666,6 @@ try:
 
 
 finally:
+    if midi_in: midi_in.close()
+    engine.quit()
     pygame.quit()
-    if play_midi:
-        midi_out.close()
-        pygame.midi.quit()
-        # XXX: Throws an error when closing. Seems to be a bug in pygames portmidi wrapper
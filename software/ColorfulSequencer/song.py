@@ -0,0 +1,53 @@
+from numpy import array, zeros, cumsum, searchsorted
+
+
+class Song(object):
+    '''Arrangement of pattern banks: a list of (bank, repeats) entries, each
+    bank is played for <repeats> bars.
+
+    compile() flattens the arrangement into an array of step events, sorted by
+    time, so playback just walks an index. Every event holds its time from the
+    start of the song, bar, step, bank, tempo and the hits of the step (see
+    KeyMatrix.tick_codes(), the steps of the whole song are counted there).
+    Changes to the patterns are only played after compiling again.'''
+
+    event_type = [('t', float), ('bar', int), ('step', int), ('bank', int),
+                  ('bpm', float), ('hits', object)]
+
+    def __init__(self, entries=None):
+        self.entries = list(entries or [])
+        self.events = zeros( 0, self.event_type )
+        self.n_bars = 0
+
+    def compile(self, key_matrix, bank_bpm):
+        '''Build the event array from the patterns of <key_matrix> and the tempo
+        of each bank in <bank_bpm>.'''
+        n = key_matrix.nsteps
+        bars = [ bank for (bank, repeats) in self.entries for r in range(repeats) \
+                     if 0 <= bank < key_matrix.nbanks ]
+        ev = zeros( len(bars)*n, self.event_type )
+        for (bar, bank) in enumerate(bars):
+            e = ev[bar*n:(bar+1)*n]
+            e['bar'], e['step'], e['bank'] = bar, range(n), bank
+            e['bpm'] = bank_bpm[bank]
+            for step in range(n):  # one by one, numpy would unpack the lists
+                e['hits'][step] = key_matrix.tick_codes( bar*n + step, bank )
+        if len(ev): ev['t'][1:] = cumsum( 60./ev['bpm'][:-1] )
+        self.events = ev
+        self.n_bars = len(bars)
+        return ev
+
+    def __len__(self):
+        return len(self.events)
+
+    def index(self, bar):
+        '''Index of the first event of <bar>.'''
+        return int( searchsorted(self.events['bar'], bar) )
+
+    def index_at(self, t):
+        '''Index of the first event at or after time <t> from the start of the song.'''
+        return int( searchsorted(self.events['t'], t) )
+
+    def duration(self):
+        if not len(self.events): return 0.
+        return self.events['t'][-1] + 60./self.events['bpm'][-1]
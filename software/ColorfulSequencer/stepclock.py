@@ -0,0 +1,191 @@
+import time, sys, threading
+from heapq import heappush, heappop
+
+if sys.platform == 'win32': timer = time.clock  # on windows, clock() is the high precision wall time
+else: timer = time.time  # on linux, clock() is the cpu time, while time() is the high accuray wall time
+
+
+class StepClock(object):
+    '''Sequencer step clock, running in its own thread.
+
+    The clock owns the current step and the time of the next step. Steps are
+    rendered <lookahead> seconds ahead of time: the callback on_render(step, t)
+    is called as soon as a step enters the lookahead window, so timestamped
+    outputs (MIDI) can be queued in the driver. on_render may return a list of
+    events (t_event, data) to be dispatched with the step, e.g. hits off the
+    step grid. Events may be up to <early> steps before the step, the owner
+    sets <early> to the earliest event it may render. Steps are rendered that
+    much ahead, too.
+
+    Rendered steps and their events are kept in a heap, sorted by time, and
+    on_step(step, t, data) is called when one is actually due: data is None
+    for the step itself, or the data of an event. Both callbacks are called
+    from the clock thread, t is the scheduled time of the step or event.
+
+    With <swing> (percent) above 50, every second step is delayed: at 50 the
+    steps are straight, at 66.7 they are in triplet feel.
+
+    on_poll(t) is called from the clock thread at least every <poll_interval>
+    seconds, also while stopped, e.g. for outputs with their own timeouts.
+    on_stop() is called from the clock thread when the clock has stopped.
+
+    To follow an external clock, call sync() regularly with the time of a step.
+
+    Waiting is done by sleeping until <spin_window> seconds before the deadline,
+    and busy waiting for the rest, so the clock is precise without burning a
+    cpu core.'''
+
+    n_steps = None
+    bpm = None
+    on_step = None
+    on_render = None
+    on_poll = None
+    on_stop = None
+    spin_window = None
+    lookahead = None
+
+    swing = 50      # Percent, see above
+    early = 0.      # Events may be scheduled this many steps before their step
+
+    step = None     # Current step, None if stopped
+    t_next = None   # Timestamp of next step to be rendered
+    t_grid = None   # Timestamp of next step to be rendered, without swing
+    step_next = None  # Next step to be rendered
+    tick_next = None  # Number of steps rendered since start
+
+    max_sleep = 0.05   # Maximum sleep slice, so we react on stop()/quit() quickly
+    poll_interval = 0.005  # Maximum interval of on_poll() calls
+
+    def __init__(self, n_steps, bpm=120, on_step=None, spin_window=0.002,
+                 on_render=None, lookahead=0.):
+        self.n_steps = n_steps
+        self.bpm = bpm
+        self.on_step = on_step
+        self.on_render = on_render
+        self.spin_window = spin_window
+        self.lookahead = lookahead
+        self._queue = []    # Heap of rendered steps and events [(t, n, step, data)], waiting for dispatch
+        self._n = 0         # Event counter, keeps events of equal time in order
+        self._run = 0       # Set to 1 to start clock, set to 0 to stop clock
+        self._start = None  # First step (t, tick) to start or restart at
+        self._sync = None   # Grid (t, tick, bpm) to lock to, see sync()
+        self._running = 0   # Flags that the clock is actually running. Only modified by clock thread.
+        self._quit = 0
+        self._thread = threading.Thread(target=self._loop, name='StepClock')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def start(self, t=None, tick=0):
+        '''Start sequencer at step 0, or at step <tick> of an endless sequence.
+        The first step is played at time <t>, default as soon as possible.
+        Restarts if already running.'''
+        self._start = (t, tick)
+        self._run = 1
+
+    def stop(self):
+        '''Stop sequencer. Note that outputs already rendered to a driver queue
+        (up to <lookahead> seconds plus <early> steps) will still be played.'''
+        self._run = 0
+
+    def is_running(self):
+        return bool(self._running)
+
+    def set_bpm(self, bpm):
+        '''Set tempo. Applies to steps not yet rendered.'''
+        self.bpm = bpm
+
+    def sync(self, t, tick, bpm):
+        '''Lock the step grid to an external clock: step <tick> (steps since
+        start, may be fractional) is at time <t>, at tempo <bpm>. Applies to
+        steps not yet rendered.'''
+        self._sync = (t, tick, bpm)
+
+    def quit(self):
+        '''Stop clock thread and wait for it to terminate.'''
+        self._run = 0
+        self._quit = 1
+        if self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def wait_until(self, t, spin=True):
+        '''Wait until timer() reaches t. Sleeps in slices, and spins for the
+        last <spin_window> seconds, unless <spin> is False. Returns False if
+        interrupted by stop() or quit().'''
+        while self._run and not self._quit:
+            dt = t - timer()
+            if dt <= 0: return True
+            if not spin: time.sleep( min(dt, self.max_sleep) )
+            elif dt > self.spin_window:
+                time.sleep( min(dt - self.spin_window, self.max_sleep) )
+        return False
+
+    def _call(self, callback, *args):
+        if callback:
+            try: return callback(*args)
+            except Exception as ex: print 'Error in step callback: %s' % str(ex)
+
+    def _push(self, t, step, data):
+        heappush( self._queue, (t, self._n, step, data) )
+        self._n += 1
+
+    def _loop(self):
+        while not self._quit:
+            if self.on_poll: self._call( self.on_poll, timer() )
+
+            if self._run and (self._start or not self._running):  # Clock is to be started
+                t_start, tick = self._start or (None, 0)
+                self._start = None
+                self._sync = None
+                self._running = 1
+                del self._queue[:]
+                if t_start == None:  # first step gets the full lookahead, too
+                    t_start = timer() + self.lookahead + self.early*60./self.bpm
+                self.t_next = t_start
+                self.t_grid = self.t_next
+                self.step_next = tick % self.n_steps
+                self.tick_next = tick
+                self.step = -1
+
+            if not self._run and self._running:  # Clock is to be stopped
+                self._running = 0
+                del self._queue[:]
+                self.step = None
+                self._call( self.on_stop )
+
+            if not self._running:
+                time.sleep( min(0.010, self.poll_interval) if self.on_poll else 0.010 )
+                continue
+
+            if self._sync:  # Move the grid of steps not yet rendered
+                t, tick, self.bpm = self._sync
+                self._sync = None
+                self.t_grid = t + (self.tick_next - tick)*60./self.bpm
+                self.t_next = self.t_grid
+                if self.tick_next % 2:  # swing
+                    self.t_next += (self.swing/50. - 1.) * 60./self.bpm
+
+            # Render all steps entering the lookahead window, early enough for their events
+            while self.t_next - self.early*60./self.bpm <= timer() + self.lookahead:
+                self._push( self.t_next, self.step_next, None )
+                for (t, data) in self._call( self.on_render, self.step_next, self.t_next ) or []:
+                    self._push( t, self.step_next, data )
+                self.step_next = (self.step_next + 1) % self.n_steps
+                self.tick_next += 1
+                self.t_grid += 60./self.bpm  # time of next beat
+                self.t_next = self.t_grid
+                if self.tick_next % 2:  # swing
+                    self.t_next += (self.swing/50. - 1.) * 60./self.bpm
+
+            # Wait for next due step or event, or next step to render, whichever comes first
+            t_wait = self.t_next - self.early*60./self.bpm - self.lookahead
+            if self._queue: t_wait = min( t_wait, self._queue[0][0] )
+            t_poll = timer() + self.poll_interval
+            if self.on_poll and t_poll < t_wait:  # Just sleep until the next poll, spin for deadlines only
+                self.wait_until( t_poll, spin=False )
+                continue
+            if not self.wait_until(t_wait): continue
+
+            if self._queue and self._queue[0][0] <= timer():
+                t, n, step, data = heappop( self._queue )
+                if data == None: self.step = step
+                self._call( self.on_step, step, t, data )
@@ -0,0 +1,56 @@
+class TimerWheel(object):
+    '''Hashed timer wheel for many pending timeouts.
+
+    Time is divided into ticks of <resolution> seconds, and each item is put
+    into the slot of its tick, modulo <n_slots>. Adding an item is O(1), and
+    expire() only visits the slots of the ticks passed since the last call,
+    so the cost per item does not depend on the number of pending items.
+    Items more than n_slots ticks ahead just stay in their slot for another
+    round of the wheel.'''
+
+    def __init__(self, resolution=0.005, n_slots=512):
+        self.resolution = resolution
+        self.slots = [ [] for i in range(n_slots) ]
+        self.tick = None    # Next tick to be expired
+        self.count = 0      # Number of pending items
+
+    def _tick(self, t):
+        return int( t / self.resolution )
+
+    def add(self, t, item):
+        '''Add <item>, due at time <t>.'''
+        n = self._tick(t)
+        if self.tick == None or n < self.tick: self.tick = n
+        self.slots[ n % len(self.slots) ].append( (t, item) )
+        self.count += 1
+
+    def expire(self, t):
+        '''Remove and return all items due until time <t>, as list of (t, item),
+        sorted by time.'''
+        if not self.count: 
+            self.tick = self._tick(t)
+            return []
+        n_slots = len(self.slots)
+        n_end = self._tick(t)
+        due = []
+        for n in range( self.tick, min(n_end, self.tick + n_slots - 1) + 1 ):
+            slot = self.slots[ n % n_slots ]
+            if not slot: continue
+            keep = [ e for e in slot if e[0] > t ]
+            if len(keep) < len(slot):
+                due.extend( [ e for e in slot if e[0] <= t ] )
+                slot[:] = keep
+        self.tick = max( self.tick, n_end )   # the slot of n_end may still hold later items
+        self.count -= len(due)
+        due.sort()
+        return due
+
+    def clear(self):
+        '''Remove and return all pending items, as list of (t, item), sorted by time.'''
+        items = sorted( [ e for slot in self.slots for e in slot ] )
+        for slot in self.slots: del slot[:]
+        self.count = 0
+        return items
+
+    def __len__(self):
+        return self.count
@@ -0,0 +1,99 @@
+from numpy import empty, nan, isfinite, percentile, concatenate, polyfit
+
+
+class TimingProbe(object):
+    '''Records timing of sequencer steps in a fixed-size ring buffer.
+
+    For every step, the scheduled time, the actual dispatch time, and the
+    completion times of the serial (Trommelbold) and MIDI writes are stored.
+    All times are in timer() time base (seconds). Records are created with new()
+    when a step is rendered and completed with mark() as outputs are written.'''
+
+    fields = ['step', 'scheduled', 'dispatch', 'serial', 'midi']
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.data = empty( (size, len(self.fields)) )
+        self.data.fill( nan )
+        self.count = 0   # Total number of records, including overwritten ones
+
+    def clear(self):
+        self.data.fill( nan )
+        self.count = 0
+
+    def new(self, step, t_scheduled):
+        '''Start a new record for a step scheduled at time <t_scheduled>.'''
+        row = self.data[ self.count % self.size ]
+        row.fill( nan )
+        row[0], row[1] = step, t_scheduled
+        self.count += 1
+
+    def mark(self, t_scheduled, field, t):
+        '''Set time <t> of <field> in the record of the step scheduled at <t_scheduled>.
+        Only the most recent records are searched, older steps are ignored.'''
+        col = self.fields.index(field)
+        for i in range(self.count-1, max(self.count-16, 0)-1, -1):
+            row = self.data[ i % self.size ]
+            if row[1] == t_scheduled:
+                row[col] = t
+                return
+
+    def records(self):
+        '''Return recorded data in chronological order, one row per step.'''
+        if self.count <= self.size: return self.data[:self.count].copy()
+        i = self.count % self.size
+        return concatenate( (self.data[i:], self.data[:i]) )
+
+    def lateness(self, field='dispatch', records=None):
+        '''Lateness of <field> relative to scheduled time for all recorded steps, in ms.'''
+        r = records if records is not None else self.records()
+        late = 1e3*( r[:, self.fields.index(field)] - r[:,1] )
+        return late[ isfinite(late) ]
+
+    def stats(self, field='dispatch'):
+        '''Return dict with lateness percentiles, jitter (std) and drift for <field>.
+        All values in ms, drift in ms per minute. Returns None if nothing was recorded.'''
+        r = self.records()   # snapshot, the step clock thread keeps on recording
+        late = self.lateness(field, r)
+        if not len(late): return None
+        s = dict( n = len(late),
+                  p50 = percentile(late, 50), p99 = percentile(late, 99),
+                  max = late.max(), jitter = late.std(), drift = 0. )
+        t = r[:,1][ isfinite( r[:, self.fields.index(field)] - r[:,1] ) ]
+        if len(late) > 1 and t.ptp() > 0:
+            s['drift'] = 60.*polyfit(t - t[0], late, 1)[0]
+        return s
+
+    def summary(self):
+        '''Return list of one-line summaries of all measured outputs.'''
+        lines = []
+        for field in self.fields[2:]:
+            s = self.stats(field)
+            if s == None: continue
+            lines.append( '%-8s n=%-5d p50 %+7.2f  p99 %+7.2f  max %+7.2f  jitter %6.2f  drift %+6.2f ms/min' %
+                          (field, s['n'], s['p50'], s['p99'], s['max'], s['jitter'], s['drift']) )
+        return lines
+
+    def dump_csv(self, filename='timing.csv'):
+        '''Write all records to a csv file, followed by the lateness percentiles as comments.'''
+        r = self.records()
+        f = open(filename, 'w')
+        f.write( ','.join(self.fields) + '\n' )
+        for row in r:
+            f.write( '%d,' % row[0] + ','.join( ['%.6f' % v if isfinite(v) else '' for v in row[1:]] ) + '\n' )
+        for line in self.summary():
+            f.write( '# ' + line + '\n' )
+        f.close()
+
+    def draw(self, surface, font, pos, color=(230,230,230), extra=[]):
+        '''Draw live summary at <pos> on <surface>, followed by the lines in <extra>.
+        Returns the changed rect.'''
+        x, y = pos
+        lines = (self.summary() or ['timing: no data']) + extra
+        rect = None
+        for line in lines:
+            text = font.render( line, True, color, (0,0,0) )
+            r = surface.blit( text, (x,y) )
+            rect = rect.union(r) if rect else r
+            y += text.get_height()
+        return rect
@@ -1,5 +1,6 @@
 
-import time
+import time, threading, os
+from collections import deque
 import serial
 from serial.tools.list_ports import comports
 
@@ -7,38 +8,186 @@ def list_ports():
     ports = [p[0] for p in comports()]
     return ports
 
+def open_port(portname, baudrate=19200, timeout=1, reset=True):
+    '''Open serial port <portname>, or the software emulation for 'sim://'.
+    With reset=False, DTR is kept low, so the Arduino does not reset.'''
+    if portname.startswith('sim://'):   # Software emulation, see trbold_sim.py
+        import trbold_sim
+        return trbold_sim.SimPort(portname, baudrate=baudrate, timeout=timeout, reset=reset)
+    port = serial.Serial(None, baudrate=baudrate, timeout=timeout)
+    port.port = portname
+    if not reset:
+        # Keep DTR low, so the Arduino does not reset on opening the port (pyserial >= 3)
+        port.dtr = False
+    port.open()
+    return port
+
+
+# The last port a Trommelbold was found on, so we can try it first on next start
+last_port_file = os.path.join( os.path.expanduser('~'), '.trommelbold_port' )
+
+def get_last_port():
+    try:
+        with open(last_port_file) as f: return f.read().strip() or None
+    except IOError: return None
+
+def set_last_port(portname):
+    try:
+        with open(last_port_file, 'w') as f: f.write(portname)
+    except IOError: pass
+
+
+# Binary protocol. Opcodes are >= 0x80, so they can never be confused with ascii
+# commands. Frames are self-delimiting, no line termination. Channel masks have
+# bit 0 set for channel 1.
+BIN_HIT      = 0x80   # <mask>            hit channels with default duration
+BIN_RELEASE  = 0x81   # <mask>            release channels
+BIN_HIT_DUR  = 0x82   # <mask> <ms>       hit channels with duration <ms>
+BIN_HIT_DURS = 0x83   # <mask> <ms>...    hit channels, one duration byte per channel in mask
+
+DEF_BAUDRATE = 19200   # Firmware starts with this baudrate
+BAUDRATES = [1000000, 500000, 250000, 115200, 57600, 38400]   # Candidates for baudrate negotiation
+
+def chan_mask(chans):
+    '''Return 8-bit mask for channel numbers 1-8 in <chans>.'''
+    mask = 0
+    for ch in chans:
+        if 1 <= ch <= 8: mask |= 1 << (ch-1)
+    return mask
+
+def encode_hit(chans, duration=None):
+    '''Encode binary hit command for channels <chans>. <duration> may be None (default
+    duration), a number of ms for all channels or a list with one value per channel.'''
+    if duration == None:
+        return chr(BIN_HIT) + chr(chan_mask(chans))
+    if isinstance(duration, (int, long, float)):
+        return chr(BIN_HIT_DUR) + chr(chan_mask(chans)) + chr(min(int(duration), 255))
+    durs = dict( zip(chans, duration) )
+    mask = chan_mask(chans)
+    return chr(BIN_HIT_DURS) + chr(mask) + \
+           ''.join( [chr(min(int(durs[ch]), 255)) for ch in range(1,9) if mask & (1 << (ch-1))] )
+
+def encode_release(chans):
+    return chr(BIN_RELEASE) + chr(chan_mask(chans))
+
+def is_binary(msg):
+    return ord(msg[0]) >= 0x80
+
 
 class TrommelboldCom(object):
-    '''Serial interface class for Arduino Trommelbold'''
+    '''Serial interface class for Arduino Trommelbold
+
+    With async_write=True, drum commands (hit, release) are queued and written
+    to the port by a background thread, so the caller never waits on the UART.
+    Commands queued while the writer is busy are coalesced into one write.
+      queue_size  maximum number of queued commands
+      overflow    policy if the queue is full: 'drop_oldest', 'drop_newest' or 'block'
+      max_late    drop commands queued longer than <max_late> seconds, None: never drop
+
+    After the handshake, the firmware is asked for binary protocol support.
+    If available, hit() and release() use compact binary commands (2-3 bytes
+    for any number of channels), otherwise the ascii commands.
+
+    If open() is given a <max_baudrate>, and the firmware supports it, the
+    baudrate is raised to the highest rate up to <max_baudrate> that passes
+    an id? check. The rate in use is reported by get_baudrate().
+
+    With reset=False, open() keeps DTR low, so the Arduino does not reset
+    and a running board answers immediately, without the 1-2 s boot time.
+    open_async() does the same in a background thread.
+    '''
     _port = None
     portname = None
+    binary = False   # Use binary protocol, negotiated in open()
 
-    def __init__(self, portname=None, baudrate=None):
+    max_cmd_len = 19   # Firmware command buffer holds 20 chars, including termination
+
+    def __init__(self, portname=None, baudrate=None, async_write=False,
+                 queue_size=16, overflow='drop_oldest', max_late=None):
+        self.async_write = async_write
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.max_late = max_late
+        self.n_written = 0      # Number of writes to the port
+        self.n_coalesced = 0    # Number of commands merged into a previous write
+        self.n_dropped = 0      # Number of commands dropped due to full queue
+        self.n_late = 0         # Number of commands dropped for being late
+        self._queue = deque()   # [(t_queued, msg, on_written)]
+        self._hit_msgs = {}     # Encoded hit commands by channel mask and durations, for current protocol
+        self._queue_bytes = 0
+        self._busy = 0          # Writer thread is currently writing
+        self._cond = threading.Condition()
+        self._port_lock = threading.Lock()
+        self._open_lock = threading.Lock()
+        if async_write:
+            self._writer = threading.Thread(target=self._write_loop, name='TrommelboldWriter')
+            self._writer.daemon = True
+            self._writer.start()
         if portname!= None:
             self.open(portname, baudrate)
 
-    def open(self, portname, baudrate=19200):
-        if baudrate==None: baudrate=19200
+    def open(self, portname, baudrate=DEF_BAUDRATE, binary=True, max_baudrate=None,
+             reset=True, progress=None):
+        '''Open port and check for Trommelbold. Returns True on success.
+        <progress> is called with a status message for every step.'''
+        with self._open_lock:
+            return self._open(portname, baudrate, binary, max_baudrate, reset, progress)
+
+    def open_async(self, portname, callback=None, **kwargs):
+        '''Open port in a background thread, see open(). When done,
+        callback(ok) is called from that thread.'''
+        def run():
+            ok = self.open(portname, **kwargs)
+            if callback: callback(ok)
+        thread = threading.Thread(target=run, name='TrommelboldOpen')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _open(self, portname, baudrate, binary, max_baudrate, reset, progress):
+        def report(msg):
+            print msg
+            if progress: progress(msg)
+        if baudrate==None: baudrate=DEF_BAUDRATE
         self.close()
-        print 'Open Trommelbold on port %s ...' % portname
+        report( 'Open Trommelbold on port %s ...' % portname )
         try:
-            self._port = serial.Serial(portname, baudrate=baudrate, timeout=1)
+            self._port = open_port(portname, baudrate, 1, reset)
             # Note: By default, the Arduino resets when opening the Com port, needs
             #   1-2 seconds to boot. The firmware sends a greeting when up and running.
             self._port.timeout = 0.05
-            if not self.is_trommelbold():
+            found = self.is_trommelbold()
+            if not found and not reset:
+                # Not reset, so the firmware may still run at a baudrate negotiated before
+                found = self.find_baudrate() != None
+                if found: report( 'Found Trommelbold at %d baud' % self._port.baudrate )
+            if not found:
                 # May be busy booting, wait for greeting message
+                report( 'Waiting for Trommelbold to boot ...' )
                 self._port.timeout = 3
                 self.readline()
                 self._port.flushInput()
                 if not self.is_trommelbold():
                     # If still not responding, something is wrong
                     self._port.close()
-                    print "Error: Did not recognize Trommelbold on port %s" % portname
-                    return
+                    report( "Error: Did not recognize Trommelbold on port %s" % portname )
+                    return False
+            protocols = self.get_protocols()
+            self.binary = binary and 'bin1' in protocols
+            self._hit_msgs.clear()
+            if max_baudrate and max_baudrate > self._port.baudrate and 'baud' in protocols:
+                report( 'Negotiating baudrate ...' )
+                if self.negotiate_baudrate(max_baudrate) == None:
+                    self.close()
+                    report( 'Error: Trommelbold on port %s lost after baudrate change' % portname )
+                    return False
             self.portname = portname
-            print 'Ok'
-        except Exception as ex: print 'Error opening port %s: %s' % (portname, str(ex))
+            if not portname.startswith('sim://'): set_last_port(portname)
+            report( 'Ok, %d baud' % self.get_baudrate() + (', binary protocol' if self.binary else '') )
+            return True
+        except Exception as ex:
+            report( 'Error opening port %s: %s' % (portname, str(ex)) )
+            return False
 
 
     def is_open(self):
@@ -46,11 +195,21 @@ class TrommelboldCom(object):
             return self._port.isOpen()
         else: return False
 
+    def is_connected(self):
+        '''Port is open and a Trommelbold answered. False while open() is still running.'''
+        return self.portname != None and self.is_open()
+
     def close(self):
+        with self._cond:
+            self._queue.clear()
+            self._queue_bytes = 0
         if self._port != None:
-            self._port.close()
+            with self._port_lock:
+                self._port.close()
         self._port = None
         self.portname = None
+        self.binary = False
+        self._hit_msgs.clear()
 
     def __del__(self):
         try: self.close()
@@ -61,9 +220,105 @@ class TrommelboldCom(object):
             print 'Error: cannot write, serial port not open.'
             return
         if not isinstance(data,str): return
-        if not (data[-1] in ['\r', '\n'] ):
+        if not is_binary(data) and not (data[-1] in ['\r', '\n'] ):
             data += '\r'
-        self._port.write(data)
+        with self._port_lock:
+            self._port.write(data)
+        self.n_written += 1
+        return True
+
+    def send(self, msg, on_written=None):
+        '''Send drum command <msg> (ascii without line termination, or binary frame).
+        In async mode, the command is queued and may be coalesced with other queued
+        drum commands. on_written() is called when the command has been written
+        to the port, from the writer thread in async mode. Not called if dropped.'''
+        if not self.async_write:
+            if self.write(msg) and on_written: on_written()
+            return
+        if not self.is_open():
+            print 'Error: cannot write, serial port not open.'
+            return
+        with self._cond:
+            while len(self._queue) >= self.queue_size:
+                if self.overflow == 'drop_newest':
+                    self.n_dropped += 1
+                    return
+                elif self.overflow == 'block':
+                    self._cond.wait()
+                else:  # drop_oldest
+                    t, old, done = self._queue.popleft()
+                    self._queue_bytes -= self._wire_len(old)
+                    self.n_dropped += 1
+            self._queue.append( (time.time(), msg, on_written) )
+            self._queue_bytes += self._wire_len(msg)
+            self._cond.notify_all()
+
+    def wait_idle(self, timeout=1.):
+        '''Wait until all queued commands have been written.'''
+        t_end = time.time() + timeout
+        with self._cond:
+            while (self._queue or self._busy) and time.time() < t_end:
+                self._cond.wait( t_end - time.time() )
+
+    def queue_depth(self):
+        return len(self._queue)
+
+    def bytes_in_flight(self):
+        '''Bytes queued, plus bytes waiting in the driver's output buffer.'''
+        n = self._queue_bytes
+        try: n += self._port.out_waiting
+        except:
+            try: n += self._port.outWaiting()
+            except: pass
+        return n
+
+    def get_stats(self):
+        return dict( queue_depth = self.queue_depth(), bytes_in_flight = self.bytes_in_flight(),
+                     written = self.n_written, coalesced = self.n_coalesced,
+                     dropped = self.n_dropped, late = self.n_late )
+
+    def _wire_len(self, msg):
+        return len(msg) if is_binary(msg) else len(msg)+1
+
+    def _merge(self, msg, more):
+        '''Merge two drum commands into one write. Returns None if not possible.'''
+        if is_binary(msg) != is_binary(more): return None
+        if not is_binary(msg):  # ascii: must fit into the firmware buffer
+            if len(msg) + len(more) <= self.max_cmd_len: return msg + more
+            return None
+        if len(msg) == 2 and len(more) == 2 and msg[0] == more[0] == chr(BIN_HIT):
+            return chr(BIN_HIT) + chr( ord(msg[1]) | ord(more[1]) )
+        return msg + more   # binary frames are self-delimiting
+
+    def _write_loop(self):
+        while 1:
+            with self._cond:
+                while not self._queue: self._cond.wait()
+                t, msg, done = self._queue.popleft()
+                self._queue_bytes -= self._wire_len(msg)
+                if self.max_late != None and time.time() - t > self.max_late:
+                    self.n_late += 1
+                    self._cond.notify_all()
+                    continue
+                # Coalesce all queued commands
+                callbacks = [done] if done else []
+                while self._queue:
+                    merged = self._merge( msg, self._queue[0][1] )
+                    if merged == None: break
+                    t, more, done = self._queue.popleft()
+                    self._queue_bytes -= self._wire_len(more)
+                    msg = merged
+                    if done: callbacks.append( done )
+                    self.n_coalesced += 1
+                self._busy = 1
+                self._cond.notify_all()
+            try:
+                if self.is_open() and self.write(msg):
+                    for done in callbacks: done()
+            except Exception as ex: print 'Error writing to Trommelbold: %s' % str(ex)
+            with self._cond:
+                self._busy = 0
+                self._cond.notify_all()
  
     def readline(self):
         if not self.is_open():
@@ -72,6 +327,7 @@ class TrommelboldCom(object):
         return self._port.readline().strip()
 
     def ask(self, cmd):
+        if self.async_write: self.wait_idle()
         self.write(cmd)
         return self.readline()
 
@@ -84,21 +340,157 @@ class TrommelboldCom(object):
         a = self.ask('trommelbold?')
         return a.lower().startswith('yessir!')
 
-    def hit( self, chan ):
-        '''Hit drum on channel. <chan> can also be a list of channels to hit.'''
-        if isinstance(chan, int):
-            msg = 'h%d' % chan
-        else:
-            try: msg = '' + ''.join( ['h%d'%int(ch) for ch in chan] )
-            except: print 'Error: invalid channel list:' + str(chan)
-        self.write( msg )
+    def get_protocols( self ):
+        '''Ask firmware for supported protocol extensions, e.g. ['ascii', 'bin1', 'baud'].
+        Older firmware does not answer, then an empty list is returned.'''
+        self._port.flushInput()
+        timeout, self._port.timeout = self._port.timeout, 0.1
+        try: a = self.ask('proto?')
+        finally: self._port.timeout = timeout
+        return a.lower().split() if a else []
+
+    def get_baudrate( self ):
+        if not self.is_open(): return None
+        return self._port.baudrate
+
+    def negotiate_baudrate( self, max_baudrate ):
+        '''Step up to the highest supported baudrate <= <max_baudrate>. Each candidate
+        is verified with id?. If that fails, the firmware falls back to its previous
+        rate after one second, and we try the next lower rate. Returns the new rate.'''
+        old = self._port.baudrate
+        for rate in [b for b in BAUDRATES if old < b <= max_baudrate]:
+            self._port.flushInput()
+            if self.ask('baud %d' % rate).lower() != 'ok %d' % rate:
+                continue   # Rate not supported by firmware
+            self._port.baudrate = rate
+            time.sleep(0.01)   # Give firmware time to switch
+            self._port.flushInput()
+            if self.ask('id?').lower().startswith('trommelbold'):
+                return rate
+            # No valid answer: go back and wait for the firmware to fall back, too
+            print 'Baudrate %d failed, falling back' % rate
+            self._port.baudrate = old
+            time.sleep(1.1)
+            self._port.flushInput()
+            if not self.is_trommelbold():
+                print 'Error: Trommelbold lost after baudrate change'
+                return None
+        return self._port.baudrate
+
+    def find_baudrate( self ):
+        '''Look for the Trommelbold at the other candidate baudrates. The firmware
+        keeps a negotiated rate until it is reset. Returns the rate, or None.'''
+        old = self._port.baudrate
+        timeout, self._port.timeout = self._port.timeout, 0.1
+        try:
+            for rate in BAUDRATES:
+                if rate == old: continue
+                self._port.baudrate = rate
+                if self.is_trommelbold(): return rate
+            self._port.baudrate = old
+            return None
+        finally: self._port.timeout = timeout
+
+    def hit( self, chan, duration=None ):
+        '''Hit drum on channel. <chan> can also be a list of channels to hit.
+        <duration> (ms, single value or one per channel) is only supported by
+        the binary protocol, in ascii mode the firmware default is used.'''
+        if isinstance(chan, int): chan = [chan]
+        try:
+            if self.binary: msg = encode_hit( [int(ch) for ch in chan], duration )
+            else: msg = ''.join( ['h%d'%int(ch) for ch in chan] )
+        except: print 'Error: invalid channel list:' + str(chan); return
+        self.send( msg )
+
+    def hit_mask( self, mask, durations=None, on_written=None ):
+        '''Hit drums given by channel bitmask, bit 0 is channel 1. <durations>
+        is a string with one byte per channel (bit), the strike duration in ms,
+        0 for the default duration. Durations need the binary protocol. Encoded
+        commands are cached by mask and durations, so this is just a lookup and a
+        send. See send() for <on_written>.'''
+        msg = self._hit_msgs.get( (mask, durations) )
+        if msg == None:
+            chans = [c+1 for c in range(mask.bit_length()) if mask & (1 << c)]
+            durs = [ ord(durations[ch-1]) if durations and ch <= len(durations) else 0 for ch in chans ]
+            if not self.binary: msg = ''.join( ['h%d'%ch for ch in chans] )
+            elif not any(durs): msg = encode_hit( chans )
+            elif min(durs) == max(durs): msg = encode_hit( chans, durs[0] )
+            else: msg = encode_hit( chans, durs )
+            self._hit_msgs[(mask, durations)] = msg
+        self.send( msg, on_written )
 
     def release( self, chan ):
         '''Hit channel. <chan> can also be a list of channels to release.'''
-        if isinstance(chan, int):
-            msg = 'r%d' % chan
-        else:
-            try: msg = ''.join( ['r%d'%int(ch) for ch in chan] )
-            except: print 'Error: invalid channel list:' + str(chan)
-        self.write( msg )
-    
+        if isinstance(chan, int): chan = [chan]
+        try:
+            if self.binary: msg = encode_release( [int(ch) for ch in chan] )
+            else: msg = ''.join( ['r%d'%int(ch) for ch in chan] )
+        except: print 'Error: invalid channel list:' + str(chan); return
+        self.send( msg )
+
+
+# -----------------------------------------------------------------------------
+# Discovery
+# -----------------------------------------------------------------------------
+
+# USB vendor ids of Arduino boards and common usb-serial chips
+USB_VIDS = [0x2341, 0x2A03, 0x1A86, 0x0403, 0x10C4]
+
+_probed = {}   # Probe results {port: id or None}, cached for the session
+
+def candidate_ports(vids=USB_VIDS):
+    '''List serial ports that may have a Trommelbold attached. Ports with a known
+    USB vendor id not in <vids> are skipped. With vids=None, all ports are returned.'''
+    ports = []
+    for p in comports():
+        vid = getattr(p, 'vid', None)   # Not available in older pyserial versions
+        if vids == None or vid == None or vid in vids:
+            ports.append( p[0] )
+    return ports
+
+def probe_port(portname, timeout=0.2, boot_timeout=2.5, reset=False):
+    '''Check for a Trommelbold on <portname>. Returns its id string, or None.
+    If it does not answer within <timeout> s, it may be booting after a reset,
+    so we wait up to <boot_timeout> s for the greeting and ask again.'''
+    trbold = TrommelboldCom()
+    try:
+        trbold._port = open_port(portname, DEF_BAUDRATE, timeout, reset)
+        if not trbold.is_trommelbold():
+            if not reset and trbold.find_baudrate(): return trbold.get_id() or '?'
+            if not boot_timeout: return None
+            trbold._port.timeout = boot_timeout
+            trbold.readline()
+            trbold._port.timeout = timeout
+            if not trbold.is_trommelbold(): return None
+        return trbold.get_id() or '?'
+    except Exception: return None
+    finally:
+        trbold.close()
+
+def discover(ports=None, refresh=False, max_workers=8, exclude=[], **probe_args):
+    '''Probe all candidate ports concurrently. Returns a list of (port, id) for
+    all ports a Trommelbold answered on. Results are cached for the session,
+    only ports not probed before are probed, unless refresh=True. Ports in
+    <exclude>, e.g. the one in use, are never probed: opening a port again
+    would change its settings and disturb the connection.'''
+    if ports == None: ports = candidate_ports()
+    slots = threading.Semaphore(max_workers)
+    def probe(port):
+        with slots:
+            _probed[port] = probe_port(port, **probe_args)
+    threads = [ threading.Thread(target=probe, args=(port,), name='TrommelboldProbe')
+                for port in ports if (refresh or port not in _probed) and port not in exclude ]
+    for thread in threads: thread.daemon = True; thread.start()
+    for thread in threads: thread.join()
+    return [ (port, _probed[port]) for port in ports if _probed.get(port) ]
+
+def get_discovered(port):
+    '''Id string of Trommelbold found on <port> by discover(), or None.'''
+    return _probed.get(port)
+
+def discover_async(callback, **kwargs):
+    '''Run discover() in a background thread, and call callback(found) from there.'''
+    thread = threading.Thread(target=lambda: callback(discover(**kwargs)), name='TrommelboldDiscover')
+    thread.daemon = True
+    thread.start()
+    return thread
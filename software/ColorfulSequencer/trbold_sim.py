@@ -0,0 +1,321 @@
+'''Software emulation of the Trommelbold firmware (via_midi_serial), behind a
+pyserial-like port, to test and benchmark the output path without hardware.
+
+Use port name 'sim://' with TrommelboldCom.open(). The emulator implements the
+firmware's serial command set (trommelbold?, id?, proto?, baud, mute, h<n>,
+r<n>, digits and binary commands), models the wire time of every byte at the
+current baudrate, MAX_BEATS voice stealing and DEF_BEAT_DURATION, and logs
+timestamped solenoid on/off events.
+
+Run this module to benchmark the latency from TrommelboldCom.hit() to the
+simulated strike.'''
+
+import time, threading
+from collections import deque
+
+from stepclock import timer
+
+# Firmware constants, see firmware/via_midi_serial
+N_CHAN = 8
+DEF_BEAT_DURATION = 0.020
+MAX_BEAT_DURATION = 0.250
+MAX_BEATS = 3
+TROMMELBOLD_ID = 'Trommelbold-v1.0'
+SERIAL_BAUDRATE = 19200
+BAUD_CONFIRM = 1.0
+BAUDRATES = [19200, 38400, 57600, 115200, 250000, 500000, 1000000]
+CMD_BUFFER = 20
+DRUM_TO_MIDI_NOTE = [60, 62, 64, 65, 67, 69, 71, 72]
+
+BIN_HIT, BIN_RELEASE, BIN_HIT_DUR, BIN_HIT_DURS = 0x80, 0x81, 0x82, 0x83
+
+
+class TrommelboldSim(object):
+    '''Model of the firmware: serial command parser and drum channels.
+    All times are in timer() time base. Solenoid events are appended to
+    <log> as (t, chan, 'on'/'off', t_write), with channels 1-8 and <t_write>
+    the time the host wrote the command.'''
+
+    serial_to_midi = True   # Firmware prints 'Fwd: ...' for every ascii hit
+
+    def __init__(self):
+        self.log = []
+        self.active = [0]*N_CHAN
+        self.t_start = [0.]*N_CHAN
+        self.duration = [0.]*N_CHAN
+        self.n_active = 0
+        self.baudrate = SERIAL_BAUDRATE
+        self.baud_unconfirmed = 0
+        self.t_baud = 0.
+        self._line = ''
+        self._bin_cmd = 0
+        self._bin_data = []
+        self._bin_need = 0
+
+    # ---- Drum channels ----------------------------------
+
+    def hit(self, ch, duration, t, t_write=None):
+        if ch >= N_CHAN: return
+        self.t_start[ch] = t
+        self.duration[ch] = min(duration, MAX_BEAT_DURATION)
+        self.log.append( (t, ch+1, 'on', t_write) )
+        if not self.active[ch]:
+            self.n_active += 1
+            while self.n_active > MAX_BEATS:
+                # Too many simultaneous beats. Release oldest, as the firmware does:
+                # ages in whole ms, channels hit in the same ms are never released
+                now, oldest, max_age = int(t*1e3), None, 0
+                for c in range(N_CHAN):
+                    if self.active[c] and now - int(self.t_start[c]*1e3) > max_age:
+                        oldest, max_age = c, now - int(self.t_start[c]*1e3)
+                if oldest == None: break
+                self.release( oldest, t )
+            self.active[ch] = 1
+
+    def release(self, ch, t):
+        if ch >= N_CHAN: return
+        if self.active[ch]:
+            self.active[ch] = 0
+            self.log.append( (t, ch+1, 'off', None) )
+            if self.n_active > 0: self.n_active -= 1
+
+    def release_all(self, t):
+        for ch in range(N_CHAN): self.release(ch, t)
+        self.n_active = 0
+
+    def advance(self, t):
+        '''Release all channels whose beat duration expired until time t.
+        Also falls back to the default baudrate, if a change was not confirmed.'''
+        while 1:
+            due = [ (self.t_start[c] + self.duration[c], c) for c in range(N_CHAN)
+                    if self.active[c] and self.t_start[c] + self.duration[c] <= t ]
+            if not due: break
+            t_end, ch = min(due)
+            self.release(ch, t_end)
+        if self.baud_unconfirmed and t - self.t_baud >= BAUD_CONFIRM:
+            self.baudrate = SERIAL_BAUDRATE
+            self.baud_unconfirmed = 0
+
+    # ---- Serial input ----------------------------------
+
+    def receive(self, c, t, t_write=None):
+        '''Process one received byte at time t. Returns the answer to send, if any.'''
+        self.advance(t)
+        if self._bin_cmd:
+            self._bin_data.append( ord(c) )
+            if len(self._bin_data) == 1:
+                mask = self._bin_data[0]
+                if self._bin_cmd == BIN_HIT_DUR: self._bin_need = 2
+                elif self._bin_cmd == BIN_HIT_DURS: self._bin_need = 1 + bin(mask).count('1')
+                else: self._bin_need = 1
+            if len(self._bin_data) >= self._bin_need:
+                self.eval_binary_cmd( self._bin_cmd, self._bin_data, t, t_write )
+                self._bin_cmd = 0
+            return ''
+        if ord(c) >= 0x80:
+            self._bin_cmd, self._bin_data = ord(c), []
+            return ''
+        if c not in '\r\n':
+            if len(self._line) < CMD_BUFFER: self._line += c
+            return ''
+        cmd, self._line = self._line[:CMD_BUFFER-1].lower(), ''
+        return self.eval_serial_cmd( cmd, t, t_write )
+
+    def eval_serial_cmd(self, cmd, t, t_write=None):
+        if cmd.startswith('trommelbold?'[:9]):
+            self.baud_unconfirmed = 0
+            return 'YESSIR!\r\n'
+        if cmd.startswith('id?'):
+            self.baud_unconfirmed = 0
+            return TROMMELBOLD_ID + '\r\n'
+        if cmd.startswith('proto?'):
+            return 'ASCII BIN1 BAUD\r\n'
+        if cmd.startswith('baud '):
+            try: baud = int(cmd[5:])
+            except ValueError: baud = 0
+            if baud not in BAUDRATES: return 'ERR\r\n'
+            self.baudrate = baud
+            self.t_baud = t
+            self.baud_unconfirmed = (baud != SERIAL_BAUDRATE)
+            return 'OK %d\r\n' % baud   # sent at the old rate, see SimPort
+        if cmd.startswith('mut'):
+            self.release_all(t)
+            return ''
+        # Drum commands
+        out = ''
+        i = 0
+        while i < len(cmd):
+            c = cmd[i]; i += 1
+            if '1' <= c <= '8':
+                ch = int(c) - 1
+                self.hit( ch, DEF_BEAT_DURATION, t, t_write )
+                out += self._fwd( ch )
+            elif c in 'hr':
+                j = i
+                while j < len(cmd) and cmd[j].isdigit(): j += 1
+                ch = int(cmd[i:j]) if j > i else 0
+                if ch > 0:
+                    if c == 'h':
+                        self.hit( ch-1, DEF_BEAT_DURATION, t, t_write )
+                        out += self._fwd( ch-1 )
+                    else: self.release( ch-1, t )
+                i = j
+        return out
+
+    def _fwd(self, ch):
+        if not self.serial_to_midi: return ''
+        note = DRUM_TO_MIDI_NOTE[ch] if ch < len(DRUM_TO_MIDI_NOTE) else -1
+        return 'Fwd: chan: %d note: %d\r\n' % (ch+1, note)
+
+    def eval_binary_cmd(self, op, data, t, t_write=None):
+        mask, durs = data[0], data[1:]
+        for ch in range(N_CHAN):
+            if not mask & (1 << ch): continue
+            if op == BIN_HIT:        self.hit( ch, DEF_BEAT_DURATION, t, t_write )
+            elif op == BIN_HIT_DUR:  self.hit( ch, durs[0]*1e-3 or DEF_BEAT_DURATION, t, t_write )
+            elif op == BIN_HIT_DURS: self.hit( ch, durs.pop(0)*1e-3 or DEF_BEAT_DURATION, t, t_write )
+            elif op == BIN_RELEASE:  self.release( ch, t )
+
+
+class SimPort(object):
+    '''pyserial-like port connected to a TrommelboldSim. Every byte takes 10 bit
+    times on the wire, in both directions. Bytes sent while host and device
+    baudrates differ are lost. With <boot_time> > 0 and <reset>, the device
+    ignores input for that long after opening, and then sends its greeting,
+    like an Arduino after the auto-reset.'''
+
+    boot_time = 0.
+
+    def __init__(self, port='sim://', baudrate=SERIAL_BAUDRATE, timeout=None, reset=True, **kwargs):
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.sim = TrommelboldSim()
+        self.is_open = True
+        self._tx = deque()    # Host to device [(t_arrival, byte, baudrate, t_write)]
+        self._rx = deque()    # Device to host [(t_arrival, byte, baudrate)]
+        self._rx_buffer = ''  # Bytes arrived at host
+        self._tx_free = self._rx_free = timer()   # Time when the line is free
+        self._cond = threading.Condition()
+        self._t_boot = timer() + (self.boot_time if reset else 0.)
+        if self.boot_time and reset: self._send( 'Yabadabadoo!\r\n', self._t_boot, SERIAL_BAUDRATE )
+        self._thread = threading.Thread(target=self._loop, name='TrommelboldSim')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _send(self, data, t, baud):
+        '''Device sends <data> at time t with baudrate <baud>'''
+        for c in data:
+            self._rx_free = max(t, self._rx_free) + 10./baud
+            self._rx.append( (self._rx_free, c, baud) )
+
+    def _loop(self):
+        while self.is_open:
+            with self._cond:
+                now = timer()
+                while self._tx and self._tx[0][0] <= now:
+                    t, c, baud, t_write = self._tx.popleft()
+                    if t < self._t_boot or baud != self.sim.baudrate: continue  # lost
+                    answer = self.sim.receive( c, t, t_write )
+                    if answer: self._send( answer, t, baud )  # baudrate changes apply after the answer
+                self.sim.advance(now)
+                while self._rx and self._rx[0][0] <= now:
+                    t, c, baud = self._rx.popleft()
+                    if baud == self.baudrate: self._rx_buffer += c
+                self._cond.notify_all()
+            time.sleep(0.0002)
+
+    # ---- pyserial interface ----------------------------------
+
+    def isOpen(self):
+        return self.is_open
+
+    def close(self):
+        self.is_open = False
+
+    def write(self, data):
+        t_write = timer()
+        with self._cond:
+            for c in data:
+                self._tx_free = max(t_write, self._tx_free) + 10./self.baudrate
+                self._tx.append( (self._tx_free, c, self.baudrate, t_write) )
+        return len(data)
+
+    def flush(self):
+        while self._tx: time.sleep(0.0005)
+
+    @property
+    def out_waiting(self):
+        return len(self._tx)
+
+    @property
+    def in_waiting(self):
+        return len(self._rx_buffer)
+
+    def inWaiting(self):
+        return self.in_waiting
+
+    def _wait(self, ready):
+        t_end = None if self.timeout == None else timer() + self.timeout
+        with self._cond:
+            while not ready() and (t_end == None or timer() < t_end):
+                self._cond.wait(0.001)
+
+    def read(self, size=1):
+        self._wait( lambda: len(self._rx_buffer) >= size )
+        with self._cond:
+            data, self._rx_buffer = self._rx_buffer[:size], self._rx_buffer[size:]
+        return data
+
+    def readline(self):
+        self._wait( lambda: '\n' in self._rx_buffer )
+        with self._cond:
+            i = self._rx_buffer.find('\n') + 1 or len(self._rx_buffer)
+            data, self._rx_buffer = self._rx_buffer[:i], self._rx_buffer[i:]
+        return data
+
+    def flushInput(self):
+        with self._cond: self._rx_buffer = ''
+
+    reset_input_buffer = flushInput
+
+    # ---- Diagnostics ----------------------------------
+
+    def strike_latencies(self):
+        '''Latency from host write to solenoid on, for all logged strikes (s).'''
+        return [ t - t_write for (t, ch, state, t_write) in self.sim.log
+                 if state == 'on' and t_write != None ]
+
+
+# -----------------------------------------------------------------------------
+# Benchmark
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    from numpy import percentile, array
+    import trbold_com
+
+    def benchmark(n=100, dt=0.020, **open_args):
+        '''Send <n> single-channel hits, every <dt> s. Returns latencies from
+        the hit() call to the simulated strike in ms.'''
+        trbold = trbold_com.TrommelboldCom( async_write=open_args.pop('async_write', 0) )
+        trbold.open( 'sim://', **open_args )
+        port = trbold._port
+        port.sim.serial_to_midi = False
+        t_calls = []
+        for i in range(n):
+            t_calls.append( timer() )
+            trbold.hit( i%N_CHAN + 1 )
+            time.sleep(dt)
+        time.sleep(0.1)
+        strikes = [ t for (t, ch, state, t_write) in port.sim.log if state == 'on' ]
+        trbold.close()
+        return 1e3*( array(strikes[-n:]) - array(t_calls[-len(strikes):]) )
+
+    for name, args in [ ('ascii, 19200', dict(binary=False)),
+                        ('binary, 19200', dict()),
+                        ('binary, 115200', dict(max_baudrate=115200)),
+                        ('binary, 115200, async', dict(max_baudrate=115200, async_write=1)) ]:
+        late = benchmark(**args)
+        print '%-24s p50 %6.2f  p99 %6.2f  max %6.2f ms' % \
+              (name, percentile(late, 50), percentile(late, 99), late.max())